@@ -17,23 +17,44 @@ Usage example:
 
 import os
 import re
+import sys
+import csv
+import json
 import time
+import atexit
+import sqlite3
+import hashlib
+import inspect
+import functools
+import threading
 import argparse
 import datetime as dt
-import pandas as pd
+from collections import defaultdict
+import requests
+import numpy as np
+import torch
 from bs4 import BeautifulSoup
-
-# Embeddings
-from sentence_transformers import SentenceTransformer, util
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 
 # Selenium
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 
 from tqdm import tqdm
 
+# Shared helpers (src/utils): dataset loader, request pacing, model loader
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from dataset import load_chapters, list_chapter_ids
+from rate_limit import RateLimiter
+from model_loader import get_model
+
 # NIH endpoints
 NIH_BASE = "https://visualsonline.cancer.gov/"
 SEARCH_URL_TPL = NIH_BASE + "searchaction.cfm?q={query}&sort=relevance"
@@ -41,61 +62,288 @@ SEARCH_URL_TPL = NIH_BASE + "searchaction.cfm?q={query}&sort=relevance"
 # ---------------------------
 # Query building
 # ---------------------------
+_WORD_RE = re.compile(r"[A-Za-z]+")
+_STOP = frozenset({
+    "the","and","of","to","a","in","is","on","for","with","by","as","that",
+    "this","from","an","or","at","be","are","it","we","was","were","but",
+    "about","into","over","without","iii","ii","iv","i","figure","chapter",
+    "introduction","section","subsection","system","systems"
+})
+
+
 def build_query(text: str, max_terms: int = 6) -> str:
     """
     Lightweight keyword extractor to form a search string for NIH.
     Semantic ranking happens later with embeddings.
     """
-    words = re.findall(r"[A-Za-z]+", text)
-    stop = {
-        "the","and","of","to","a","in","is","on","for","with","by","as","that",
-        "this","from","an","or","at","be","are","it","we","was","were","but",
-        "about","into","over","without","iii","ii","iv","i","figure","chapter",
-        "introduction","section","subsection","system","systems"
-    }
-    kws = [w for w in words if w.lower() not in stop and len(w) > 2]
-    # keep order, de-dup
-    seen = set()
-    uniq = []
-    for w in kws:
+    # keep order, de-dup case-insensitively (first spelling wins)
+    uniq = {}
+    for w in _WORD_RE.findall(text):
         wl = w.lower()
-        if wl not in seen:
-            seen.add(wl)
-            uniq.append(w)
-    return "+".join(uniq[:max_terms]) if uniq else "cancer"
+        if len(w) > 2 and wl not in _STOP:
+            uniq.setdefault(wl, w)
+    return "+".join(list(uniq.values())[:max_terms]) if uniq else "cancer"
+
+
+def is_trivial(text: str, query: str, prev_text: str = None, min_chars: int = 40) -> bool:
+    """
+    Early-exit gate: paragraphs that rarely yield useful images and are not
+    worth an NIH search - too short, only the fallback query or a single
+    keyword, or a verbatim repeat of the previous paragraph.
+    """
+    stripped = text.strip()
+    if len(stripped) < min_chars:
+        return True
+    if query == "cancer" or len(query.split("+")) < 2:
+        return True
+    return prev_text is not None and stripped == prev_text.strip()
 
 
 # ---------------------------
 # Selenium driver
 # ---------------------------
+# One headless Chrome per process, reused across main() calls (e.g. from a notebook)
+_DRIVER = None
+_DRIVER_LOCK = threading.Lock()
+
+
 def get_selenium_driver():
-    opts = Options()
-    opts.add_argument("--headless=new")
-    opts.add_argument("--disable-gpu")
-    opts.add_argument("--no-sandbox")
-    opts.add_argument("--disable-dev-shm-usage")
-    opts.add_argument("--log-level=3")
+    """
+    Return the shared headless Chrome driver, starting it on first use.
+    The driver is closed automatically at interpreter exit.
+    """
+    global _DRIVER
+    with _DRIVER_LOCK:
+        if _DRIVER is None:
+            opts = Options()
+            opts.add_argument("--headless=new")
+            opts.add_argument("--disable-gpu")
+            opts.add_argument("--no-sandbox")
+            opts.add_argument("--disable-dev-shm-usage")
+            opts.add_argument("--log-level=3")
+
+            service = Service(ChromeDriverManager().install())
+            _DRIVER = webdriver.Chrome(service=service, options=opts)
+            atexit.register(close_selenium_driver)
+        return _DRIVER
+
+
+def close_selenium_driver():
+    """Quit the shared driver (if running)."""
+    global _DRIVER
+    with _DRIVER_LOCK:
+        if _DRIVER is not None:
+            _DRIVER.quit()
+            _DRIVER = None
+
 
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=opts)
-    return driver
+# ---------------------------
+# NIH rate limiting
+# ---------------------------
+# One limiter shared by every fetch thread
+NIH_LIMITER = RateLimiter(interval=1.5)
+
+
+# ---------------------------
+# NIH search cache (SQLite)
+# ---------------------------
+QUERY_CACHE_DB = "data/nih_query_cache.sqlite"
+QUERY_CACHE_TTL = 30 * 24 * 3600  # seconds
+QUERY_CACHE_ENABLED = True
+CANDIDATE_FIELDS = ("title", "detail_url", "thumbnail", "snippet")
+
+_query_cache_conn = None
+_query_cache_lock = threading.Lock()
+
+
+def _query_cache_key(query: str, limit: int) -> str:
+    norm = " ".join(query.lower().split())
+    return hashlib.blake2b(f"{norm}|{limit}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _query_cache():
+    global _query_cache_conn
+    if _query_cache_conn is None:
+        os.makedirs(os.path.dirname(QUERY_CACHE_DB), exist_ok=True)
+        _query_cache_conn = sqlite3.connect(QUERY_CACHE_DB, check_same_thread=False)
+        _query_cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS candidates (key TEXT PRIMARY KEY, json TEXT, ts INTEGER)"
+        )
+    return _query_cache_conn
+
+
+def cached_candidates(query: str, limit: int):
+    """Return the cached candidates for query + limit, or None on a miss/expiry."""
+    if not QUERY_CACHE_ENABLED:
+        return None
+    key = _query_cache_key(query, limit)
+    with _query_cache_lock:
+        row = _query_cache().execute(
+            "SELECT json, ts FROM candidates WHERE key = ?", (key,)
+        ).fetchone()
+    if row is not None and time.time() - row[1] <= QUERY_CACHE_TTL:
+        return json.loads(row[0])
+    return None
+
+
+def cache_by_query(fn):
+    """
+    Cache a NIH search function's parsed candidates on disk, keyed by the
+    normalized query + limit. Failed searches (None) are not cached.
+    """
+    sig = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not QUERY_CACHE_ENABLED:
+            return fn(*args, **kwargs)
+
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        query, limit = bound.arguments["query"], bound.arguments["limit"]
+        cached = cached_candidates(query, limit)
+        if cached is not None:
+            return cached
+        key = _query_cache_key(query, limit)
+
+        results = fn(*args, **kwargs)
+        if results is not None:
+            slim = [{f: c.get(f, "") for f in CANDIDATE_FIELDS} for c in results]
+            with _query_cache_lock:
+                conn = _query_cache()
+                conn.execute(
+                    "INSERT OR REPLACE INTO candidates (key, json, ts) VALUES (?, ?, ?)",
+                    (key, json.dumps(slim), int(time.time()))
+                )
+                conn.commit()
+        return results
+
+    return wrapper
+
+
+# ---------------------------
+# NIH search (plain HTTP, concurrent)
+# ---------------------------
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
+HTTP_SESSION.headers.update({
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+})
+# Present on every server-rendered results page, including searches with no hits
+RESULTS_MARKER = "refine-search-results"
+
+
+@cache_by_query
+def nih_search_candidates_http(query: str, limit: int = 20):
+    """
+    Fetch NIH search results without a browser.
+    Returns the same candidate dicts as nih_search_candidates ([] for a search
+    with no hits), or None when the page has no result markup (e.g. it needs JS
+    rendering) or the request fails, so the caller can fall back to Selenium.
+    """
+    NIH_LIMITER.acquire()
+    try:
+        resp = HTTP_SESSION.get(SEARCH_URL_TPL.format(query=query), timeout=30)
+        resp.raise_for_status()
+    except requests.RequestException:
+        return None
+    results = parse_candidates(resp.text, limit)
+    if not results and RESULTS_MARKER not in resp.text:
+        return None
+    return results
+
+
+def fetch_and_encode(model, queries: list, limit: int = 20, workers: int = 4,
+                     fetcher: str = "http", render_timeout: float = 5.0, batch_queries: int = 32):
+    """
+    Two-stage pipeline: NIH searches run on worker threads while the main thread
+    encodes the candidates of finished searches, `batch_queries` at a time, so
+    network and model time overlap instead of adding up.
+    Pages that do not come back over HTTP are rendered on a single Selenium
+    thread (the shared driver is not thread-safe).
+    Returns (candidates_by_query, all_candidates, cand_embs); queries appear in
+    candidates_by_query in the same order as their slices of all_candidates.
+    """
+    candidates_by_query = {}
+    all_candidates, emb_chunks, batch = [], [], []
+
+    def render(query):
+        # Check the cache first so a fully cached rerun never starts Chrome
+        cached = cached_candidates(query, limit)
+        if cached is not None:
+            return cached
+        return nih_search_candidates(
+            get_selenium_driver(), query=query, limit=limit, timeout=render_timeout
+        )
+
+    def flush():
+        if batch:
+            emb_chunks.append(encode_candidates(model, batch))
+            batch.clear()
+
+    with ThreadPoolExecutor(max_workers=workers) as http_ex, \
+            ThreadPoolExecutor(max_workers=1) as selenium_ex:
+        if fetcher == "http":
+            pending = {http_ex.submit(nih_search_candidates_http, q, limit): (q, "http") for q in queries}
+        else:
+            pending = {selenium_ex.submit(render, q): (q, "selenium") for q in queries}
+
+        with tqdm(total=len(queries), desc="Fetching + encoding") as bar:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    query, stage = pending.pop(fut)
+                    candidates = fut.result()
+                    if candidates is None and stage == "http":
+                        pending[selenium_ex.submit(render, query)] = (query, "selenium")
+                        continue
+                    candidates = candidates or []
+                    candidates_by_query[query] = candidates
+                    all_candidates.extend(candidates)
+                    batch.extend(candidates)
+                    bar.update(1)
+                    if len(candidates_by_query) % batch_queries == 0:
+                        flush()
+        flush()
+
+    cand_embs = torch.cat(emb_chunks) if emb_chunks else None
+    return candidates_by_query, all_candidates, cand_embs
 
 
 # ---------------------------
 # NIH search (Selenium)
 # ---------------------------
-def nih_search_candidates(driver, query: str, limit: int = 20, sleep_sec: float = 2.0):
+@cache_by_query
+def nih_search_candidates(driver, query: str, limit: int = 20, timeout: float = 5.0):
     """
     Use Selenium to render NIH Visuals Online search results and collect candidates:
     Returns list of dicts: [{title, detail_url, thumbnail, snippet}]
+    Parsing starts as soon as the first result appears (or after `timeout`
+    seconds, e.g. when the search has no results).
     """
     search_url = SEARCH_URL_TPL.format(query=query)
     print(f"🔎 NIH URL: {search_url}")
+    NIH_LIMITER.acquire()
     driver.get(search_url)
-    time.sleep(sleep_sec)
+    try:
+        WebDriverWait(driver, timeout).until(
+            EC.presence_of_element_located((By.CLASS_NAME, "resultsitempic"))
+        )
+    except TimeoutException:
+        pass
 
-    html = driver.page_source
-    soup = BeautifulSoup(html, "html.parser")
+    return parse_candidates(driver.page_source, limit)
+
+
+def parse_candidates(html: str, limit: int = 20):
+    """
+    Parse an NIH search result page into candidate dicts.
+    """
+    soup = BeautifulSoup(html, "lxml")
 
     results = []
     containers = soup.find_all("div", class_="resultsitempic")
@@ -140,76 +388,194 @@ def extract_image_id(detail_url: str) -> str:
     """
     NIH detail URLs look like: .../details.cfm?imageid=12345
     """
-    if not detail_url:
-        return ""
-    m = re.search(r"imageid=(\d+)", detail_url)
-    return m.group(1) if m else ""
+    _, sep, tail = (detail_url or "").rpartition("imageid=")
+    return tail.split("&", 1)[0] if sep else ""
 
 
-def rank_candidates(model, paragraph_text: str, candidates: list):
+def load_model(backend: str = "torch"):
     """
-    Rank NIH candidates by semantic similarity (title + snippet) vs paragraph_text.
-    Returns list of candidates with 'match_score' sorted descending.
+    Load all-MiniLM-L6-v2 on the requested backend.
+    torch: eager PyTorch (GPU + fp16 when CUDA is available)
+    onnx / onnx-int8: ONNX Runtime on CPU
     """
-    if not candidates:
-        return []
+    return get_model("all-MiniLM-L6-v2", backend)
 
-    para_emb = model.encode(paragraph_text, convert_to_tensor=True)
+
+def compile_encoder(model):
+    """
+    Wrap the transformer inside a SentenceTransformer with torch.compile.
+    dynamic=True keeps one graph across batch/sequence lengths instead of
+    recompiling per shape. A warm-up encode forces compilation so any failure
+    surfaces here; in that case the eager module is restored.
+    """
+    first = model._first_module()
+    eager = first.auto_model
+    try:
+        first.auto_model = torch.compile(eager, mode="reduce-overhead", dynamic=True)
+        model.encode(["warm up the compiled encoder"], convert_to_tensor=True)
+        print("⚡ torch.compile enabled for the encoder")
+    except Exception as e:
+        first.auto_model = eager
+        print(f"⚠️ torch.compile failed, using eager mode: {e}")
+    return model
+
+
+def encode_candidates(model, candidates: list):
+    """
+    Encode NIH candidates (title + snippet) into L2-normalized embeddings.
+    """
     cand_texts = [
         (c.get("title","") + " " + c.get("snippet","")).strip() for c in candidates
     ]
-    cand_embs = model.encode(cand_texts, convert_to_tensor=True)
+    return model.encode(
+        cand_texts, batch_size=64, convert_to_tensor=True, normalize_embeddings=True
+    )
 
-    sims = util.cos_sim(para_emb, cand_embs).cpu().numpy().flatten()
 
-    scored = []
-    for c, s in zip(candidates, sims):
-        cc = dict(c)
-        cc["match_score"] = float(s)
-        cc["image_id"] = extract_image_id(c.get("detail_url",""))
-        scored.append(cc)
+def score_paragraphs(para_embs, cand_embs, col_ranges, k: int, chunk: int = 256):
+    """
+    Score every paragraph against the global candidate pool in chunked matmuls.
+    col_ranges is a (P, 2) LongTensor: paragraph p may only match candidate
+    columns [start, end) (its own query's candidates); other columns are masked.
+    Returns (values, indices) numpy arrays of shape (P, k), sorted descending;
+    masked slots come back as -inf.
+    """
+    cols = torch.arange(cand_embs.shape[0], device=cand_embs.device)
+    top_vals, top_idx = [], []
+    for i in range(0, para_embs.shape[0], chunk):
+        # Both sides are unit-length, so cosine similarity is a plain dot product
+        # (fp16 on GPU; cast back to fp32 for scoring)
+        S = (para_embs[i:i + chunk] @ cand_embs.T).float()
+        lo, hi = col_ranges[i:i + chunk, 0:1], col_ranges[i:i + chunk, 1:2]
+        S.masked_fill_((cols < lo) | (cols >= hi), float("-inf"))
+        vals, idx = torch.topk(S, k, dim=1)
+        top_vals.append(vals.cpu())
+        top_idx.append(idx.cpu())
+    return torch.cat(top_vals).numpy(), torch.cat(top_idx).numpy()
+
+
+def _dedup_ranked(positions, scores, image_codes, topk: int, global_best, bump: float):
+    """
+    Apply the duplicate policy to candidate positions, best score first.
+    Fully vectorized over the typed arrays - no per-candidate Python work.
+    """
+    order = positions[np.argsort(-scores[positions], kind="stable")]
+    codes = image_codes[order]
+
+    # Global duplicate rule (unknown images, code -1, are never blocked)
+    prev = np.where(codes >= 0, global_best[np.maximum(codes, 0)], -np.inf)
+    keep = scores[order] >= prev + bump
+    order, codes = order[keep], codes[keep]
 
-    scored.sort(key=lambda x: x["match_score"], reverse=True)
-    return scored
+    # Within-paragraph de-dup: first (best) occurrence of each image
+    _, first = np.unique(codes, return_index=True)
+    return order[np.sort(first)][:topk]
 
 
-def select_top_with_dedup(scored, topk: int, min_score: float, global_best: dict, bump: float = 0.05):
+def select_top_with_dedup(scores, image_codes, topk: int, min_score: float, global_best, bump: float = 0.05):
     """
-    Smart duplicate policy:
+    Smart duplicate policy over parallel typed arrays (scores need not be sorted):
     - Allow duplicates across paragraphs only if the new score is at least (prev_best + bump).
-    - Always de-duplicate within a paragraph (unique image_id).
+    - Always de-duplicate within a paragraph (unique image).
+    image_codes are int64 dense image ids (-1 = no image id); global_best is a
+    float32 array indexed by image code (-inf = not seen yet), updated in place.
+    Only the best topk*2 eligible scores are considered first (argpartition);
+    all eligible scores are used only if duplicates exhaust that window.
+    Returns positions into scores/image_codes of the chosen entries, best first.
     """
-    chosen = []
-    used_ids = set()
+    eligible = np.flatnonzero(scores >= min_score)
+    window = min(topk * 2, eligible.size)
+    if window < eligible.size:
+        head = eligible[np.argpartition(-scores[eligible], window - 1)[:window]]
+        chosen = _dedup_ranked(head, scores, image_codes, topk, global_best, bump)
+        if len(chosen) < topk:
+            chosen = _dedup_ranked(eligible, scores, image_codes, topk, global_best, bump)
+    else:
+        chosen = _dedup_ranked(eligible, scores, image_codes, topk, global_best, bump)
 
-    for c in scored:
-        if len(chosen) >= topk:
-            break
-        if c["match_score"] < min_score:
-            continue
+    # Update global best scores
+    codes = image_codes[chosen]
+    known = codes >= 0
+    np.maximum.at(global_best, codes[known], scores[chosen][known])
 
-        imgid = c.get("image_id", "")
-        if imgid in used_ids:
-            continue  # within-paragraph duplicate
+    return chosen
 
-        # Global duplicate rule
-        prev = global_best.get(imgid, None)
-        if prev is not None and c["match_score"] < (prev + bump):
-            continue  # not strong enough to reuse globally
 
-        chosen.append(c)
-        used_ids.add(imgid)
+# ---------------------------
+# Output
+# ---------------------------
+OUTPUT_COLUMNS = [
+    "chapter_id", "paragraph_id", "query", "picked_title", "detail_url",
+    "thumbnail", "image_id", "match_score", "candidate_count", "rank"
+]
 
-    # Update global best scores
-    for c in chosen:
-        imgid = c.get("image_id", "")
-        if not imgid:
-            continue
-        prev = global_best.get(imgid, None)
-        if prev is None or c["match_score"] > prev:
-            global_best[imgid] = c["match_score"]
 
-    return chosen
+class ResultWriter:
+    """
+    Incrementally write result rows as they are produced.
+    - csv: streamed through csv.DictWriter and flushed after every row batch
+    - parquet: buffered into Arrow record batches of `batch_rows` rows
+    """
+
+    def __init__(self, path: str, fmt: str = "csv", batch_rows: int = 128):
+        self.path = path
+        self.fmt = fmt
+        self.batch_rows = batch_rows
+        self.count = 0
+        if fmt == "csv":
+            self._fh = open(path, "w", newline="", encoding="utf-8")
+            self._csv = csv.DictWriter(self._fh, fieldnames=OUTPUT_COLUMNS)
+            self._csv.writeheader()
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._pa = pa
+            self._schema = pa.schema([
+                ("chapter_id", pa.string()),
+                ("paragraph_id", pa.int64()),
+                ("query", pa.string()),
+                ("picked_title", pa.string()),
+                ("detail_url", pa.string()),
+                ("thumbnail", pa.string()),
+                ("image_id", pa.string()),
+                ("match_score", pa.float64()),
+                ("candidate_count", pa.int64()),
+                ("rank", pa.int64()),
+            ])
+            self._pq = pq.ParquetWriter(path, self._schema)
+            self._buf = {c: [] for c in OUTPUT_COLUMNS}
+
+    def write(self, row: dict):
+        self.count += 1
+        if self.fmt == "csv":
+            self._csv.writerow(row)
+        else:
+            for c in OUTPUT_COLUMNS:
+                v = row.get(c, "")
+                # empty audit rows use "" for numeric fields → nulls in Parquet
+                self._buf[c].append(None if v == "" and c in ("match_score", "rank") else v)
+        if self.count % self.batch_rows == 0:
+            self._flush()
+
+    def _flush(self):
+        if self.fmt == "csv":
+            self._fh.flush()
+        elif self._buf["chapter_id"]:
+            self._pq.write_batch(self._pa.record_batch(self._buf, schema=self._schema))
+            self._buf = {c: [] for c in OUTPUT_COLUMNS}
+
+    def close(self):
+        self._flush()
+        if self.fmt == "csv":
+            self._fh.close()
+        else:
+            self._pq.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 # ---------------------------
@@ -222,14 +588,26 @@ def main():
     parser.add_argument("--max-per-para", type=int, default=20, help="Max NIH candidates per paragraph")
     parser.add_argument("--topk", type=int, default=3, help="Save top-k matches per paragraph")
     parser.add_argument("--min-score", type=float, default=0.40, help="Minimum similarity score to keep")
-    parser.add_argument("--sleep", type=float, default=2.0, help="Seconds to sleep after each search")
+    parser.add_argument("--sleep", type=float, default=1.5, help="Minimum seconds between NIH requests (shared by all workers)")
+    parser.add_argument("--render-timeout", type=float, default=5.0, help="Max seconds to wait for Selenium results to render")
+    parser.add_argument("--fetcher", choices=["http", "selenium"], default="http",
+                        help="Fetch NIH results over plain HTTP (concurrent, Selenium fallback) or Selenium only")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent NIH requests for --fetcher http")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore the on-disk NIH query cache")
+    parser.add_argument("--backend", choices=["torch", "onnx", "onnx-int8"], default="torch",
+                        help="Encoder backend; onnx/onnx-int8 run on CPU via ONNX Runtime, needs sentence-transformers[onnx]")
+    parser.add_argument("--compile", action="store_true", help="Compile the encoder with torch.compile (torch backend)")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv", help="Output file format")
     args = parser.parse_args()
 
+    global QUERY_CACHE_ENABLED
+    QUERY_CACHE_ENABLED = not args.no_cache
+    NIH_LIMITER.interval = args.sleep
+
     os.makedirs("data", exist_ok=True)
-    df = pd.read_csv("data/chapters_dataset.csv")
 
     # Normalize chapter id (accept "31" or "31_")
-    chids = set(df["chapter_id"].astype(str).unique())
+    chids = set(list_chapter_ids())
     if args.chapter not in chids:
         norm = args.chapter.rstrip("_")
         match = [c for c in chids if c.rstrip("_") == norm]
@@ -240,80 +618,129 @@ def main():
     else:
         chapter_id = args.chapter
 
-    dfc = df[df["chapter_id"].astype(str) == chapter_id].copy()
+    dfc = load_chapters(chapter_id)
     if dfc.empty:
         print(f"⚠️ No rows for chapter {chapter_id}")
         return
 
     # Timestamped output
     ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_csv = f"data/paragraph_image_map_{chapter_id}_{ts}.csv"
+    out_path = f"data/paragraph_image_map_{chapter_id}_{ts}.{args.format}"
 
     print(f"📖 Processing chapter {chapter_id}: {len(dfc)} paragraphs")
     print(f"⚙️  Settings → topk={args.topk} | min_score={args.min_score:.2f} | max_per_para={args.max_per_para}")
 
-    # Load model and driver
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-    driver = get_selenium_driver()
-
-    rows = []
-    global_best_by_img = {}  # image_id -> best score seen so far (for smart duplicate policy)
+    # Load model (the Selenium driver is only started if some page needs it)
+    model = load_model(args.backend)
+    if args.compile and args.backend == "torch":
+        compile_encoder(model)
 
-    # Progress bar over selected rows
     work_df = dfc.iloc[::args.every]
-    for _, row in tqdm(work_df.iterrows(), total=len(work_df), desc="Matching images"):
-        para_id = int(row["paragraph_id"])
-        text = str(row["text"])
-
-        # Build + search
-        query = build_query(text)
-        candidates = nih_search_candidates(driver, query=query, limit=args.max_per_para, sleep_sec=args.sleep)
-
-        # Rank
-        scored = rank_candidates(model, text, candidates)
-
-        # Select top with smart de-duplication
-        best = select_top_with_dedup(scored, topk=args.topk, min_score=args.min_score, global_best=global_best_by_img)
-
-        if not best:
-            # Save an empty row (still useful for auditing)
-            rows.append({
-                "chapter_id": chapter_id,
-                "paragraph_id": para_id,
-                "query": query,
-                "picked_title": "",
-                "detail_url": "",
-                "thumbnail": "",
-                "image_id": "",
-                "match_score": "",
-                "candidate_count": len(candidates),
-                "rank": ""
-            })
-        else:
-            for rank, item in enumerate(best, 1):
-                rows.append({
+
+    # Encode every selected paragraph up front in one batched call
+    para_texts = work_df["text"].astype(str).tolist()
+    para_embs = model.encode(
+        para_texts, batch_size=64, convert_to_tensor=True,
+        normalize_embeddings=True, show_progress_bar=True
+    )
+
+    # Group paragraphs by query: each unique query is fetched and its
+    # candidates encoded once, however many paragraphs share it
+    # (trivial paragraphs are skipped and get an empty audit row)
+    queries = [build_query(t) for t in para_texts]
+    trivial = [
+        is_trivial(t, q, para_texts[i - 1] if i else None)
+        for i, (t, q) in enumerate(zip(para_texts, queries))
+    ]
+    groups = defaultdict(list)
+    for pid, q in enumerate(queries):
+        if not trivial[pid]:
+            groups[q].append(pid)
+    unique_queries = list(groups)
+    if any(trivial):
+        print(f"⏭️  Skipping {sum(trivial)} trivial paragraphs")
+
+    # Fetch NIH results and encode their candidates as they arrive
+    workers = args.workers if args.fetcher == "http" else 1
+    print(f"🔎 Fetching {len(unique_queries)} unique NIH searches ({workers} workers)...")
+    candidates_by_query, all_candidates, cand_embs = fetch_and_encode(
+        model, unique_queries, limit=args.max_per_para, workers=args.workers,
+        fetcher=args.fetcher, render_timeout=args.render_timeout
+    )
+
+    # All candidates form one pool; each paragraph may only match the column
+    # range belonging to its own query
+    col_ranges = torch.zeros((len(para_texts), 2), dtype=torch.long)
+    start = 0
+    for query, candidates in candidates_by_query.items():
+        pids = groups[query]
+        col_ranges[pids, 0] = start
+        col_ranges[pids, 1] = start + len(candidates)
+        start += len(candidates)
+
+    # Chunked P x C matmul + top-k over the pooled candidates
+    all_image_ids = np.array(
+        [extract_image_id(c.get("detail_url","")) for c in all_candidates], dtype=object
+    )
+    # Dense int64 codes per image (-1 = no id) and the best score seen so far
+    # per code, for the smart duplicate policy
+    uniq_ids, image_codes = np.unique(all_image_ids.astype(str), return_inverse=True)
+    image_codes = image_codes.astype(np.int64)
+    image_codes[all_image_ids == ""] = -1
+    global_best_by_img = np.full(len(uniq_ids), -np.inf, dtype=np.float32)
+    if all_candidates:
+        k = min(len(all_candidates), max(len(c) for c in candidates_by_query.values()))
+        top_vals, top_idx = score_paragraphs(para_embs, cand_embs, col_ranges.to(cand_embs.device), k)
+
+    with ResultWriter(out_path, fmt=args.format) as writer:
+        # Selection runs in paragraph order so the duplicate policy is unchanged
+        for i, (_, row) in enumerate(work_df.iterrows()):
+            para_id = int(row["paragraph_id"])
+            query = queries[i]
+            candidates = [] if trivial[i] else candidates_by_query.get(query, [])
+
+            # Select top with smart de-duplication (masked -inf slots never pass min_score)
+            best = []
+            if all_candidates and not trivial[i]:
+                vals, idx = top_vals[i], top_idx[i]
+                chosen = select_top_with_dedup(
+                    vals, image_codes[idx], topk=args.topk, min_score=args.min_score, global_best=global_best_by_img
+                )
+                best = [
+                    dict(all_candidates[idx[j]], match_score=float(vals[j]), image_id=all_image_ids[idx[j]])
+                    for j in chosen
+                ]
+
+            if not best:
+                # Save an empty row (still useful for auditing)
+                writer.write({
                     "chapter_id": chapter_id,
                     "paragraph_id": para_id,
                     "query": query,
-                    "picked_title": item.get("title",""),
-                    "detail_url": item.get("detail_url",""),
-                    "thumbnail": item.get("thumbnail",""),
-                    "image_id": item.get("image_id",""),
-                    "match_score": round(item.get("match_score", 0.0), 4),
+                    "picked_title": "",
+                    "detail_url": "",
+                    "thumbnail": "",
+                    "image_id": "",
+                    "match_score": "",
                     "candidate_count": len(candidates),
-                    "rank": rank
+                    "rank": ""
                 })
-
-        # polite delay between different queries
-        time.sleep(args.sleep)
-
-    # Cleanup
-    driver.quit()
-
-    # Write results
-    out_df = pd.DataFrame(rows)
-    out_df.to_csv(out_csv, index=False)
-    print(f"✅ Saved {len(out_df)} rows → {out_csv}")
+            else:
+                for rank, item in enumerate(best, 1):
+                    writer.write({
+                        "chapter_id": chapter_id,
+                        "paragraph_id": para_id,
+                        "query": query,
+                        "picked_title": item.get("title",""),
+                        "detail_url": item.get("detail_url",""),
+                        "thumbnail": item.get("thumbnail",""),
+                        "image_id": item.get("image_id",""),
+                        "match_score": round(item.get("match_score", 0.0), 4),
+                        "candidate_count": len(candidates),
+                        "rank": rank
+                    })
+
+    print(f"✅ Saved {writer.count} rows → {out_path}")
 
 
 if __name__ == "__main__":
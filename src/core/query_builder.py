@@ -1,19 +1,20 @@
 # src/query_builder.py
 import argparse
-import pandas as pd
 import sys
 import os
 import re
 from collections import Counter
 
-DATA_FILE = "data/chapters_dataset.csv"
+# Shared dataset loader (src/utils/dataset.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from dataset import load_chapters, list_chapter_ids
+
 OUTPUT_QUERY_FILE = "data/query_text.txt"
 
 def list_available_chapters():
     """List unique chapter IDs from the dataset"""
     try:
-        df = pd.read_csv(DATA_FILE)
-        chapters = sorted(df["chapter_id"].unique())
+        chapters = list_chapter_ids()
         print("\n📖 Available chapters in dataset:")
         for ch in chapters:
             print(f" - {ch}")
@@ -22,38 +23,42 @@ def list_available_chapters():
         print(f"❌ Could not read dataset: {e}")
 
 def clean_and_extract_keywords(text, max_terms=10):
-    """Extract top frequent meaningful words from the text."""
+    """Extract top frequent meaningful words from the text (a string or an iterable of strings)."""
     stop = {
         "the","and","of","to","a","in","is","on","for","with","by","as","that","this",
         "from","an","or","at","be","are","it","we","was","were","but","about","into",
         "over","without","figure","chapter","introduction","section","system","systems",
         "cells","cell","study","shown","figure","fig","data"
     }
-    words = re.findall(r"[A-Za-z]+", text.lower())
-    words = [w for w in words if w not in stop and len(w) > 3]
-    common = [w for w, _ in Counter(words).most_common(max_terms)]
+    counts = Counter()
+    for chunk in ([text] if isinstance(text, str) else text):
+        words = re.findall(r"[A-Za-z]+", chunk.lower())
+        counts.update(w for w in words if w not in stop and len(w) > 3)
+    common = [w for w, _ in counts.most_common(max_terms)]
     return " ".join(common)
 
 def main(chapter_id, short_mode=False):
     try:
-        df = pd.read_csv(DATA_FILE)
-        df_chapter = df[df["chapter_id"].astype(str) == str(chapter_id)]
+        df_chapter = load_chapters(chapter_id)
         if df_chapter.empty:
             print(f"⚠️ No data found for Chapter {chapter_id}")
             return
 
-        # Join all paragraphs
-        full_text = " ".join(df_chapter["text"].tolist())
-
-        # If short mode, generate keyword query
-        query_text = (
-            clean_and_extract_keywords(full_text, max_terms=12)
-            if short_mode else full_text
-        )
+        # Paragraphs are streamed one at a time; the chapter is never
+        # materialized as a single joined string
+        paragraphs = df_chapter["text"].astype(str).values
 
         os.makedirs("data", exist_ok=True)
         with open(OUTPUT_QUERY_FILE, "w", encoding="utf-8") as f:
-            f.write(query_text)
+            if short_mode:
+                # Keyword query counted paragraph by paragraph
+                f.write(clean_and_extract_keywords(paragraphs, max_terms=12))
+            else:
+                # Full text: paragraphs separated by single spaces
+                for i, para in enumerate(paragraphs):
+                    if i:
+                        f.write(" ")
+                    f.write(para)
 
         mode_str = "short keyword query" if short_mode else "full text"
         print(f"✅ Saved Chapter {chapter_id} {mode_str} → {OUTPUT_QUERY_FILE}")
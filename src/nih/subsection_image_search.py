@@ -13,19 +13,153 @@ import time
 import random
 import re
 import os
+import csv
+import sqlite3
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote_plus
 
 BASE_URL = "https://visualsonline.cancer.gov/"
 
-def search_nih_by_query(query, limit=10, delay=5):
+# Persistent session: reuse the TCP/TLS connection across subsection queries
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=8))
+SESSION.headers.update({
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+})
+
+# On-disk cache of search result pages, keyed by the full search URL
+CACHE_DB = "data/.nih_http_cache.sqlite"
+CACHE_TTL = 30 * 24 * 3600  # 30 days
+_CACHE_CONN = None
+
+MAPPING_COLUMNS = [
+    'chapter_id', 'subsection_id', 'subsection_name', 'query', 'picked_title',
+    'detail_url', 'thumbnail', 'image_id', 'rank', 'candidate_count'
+]
+
+class AdaptiveDelay:
+    """
+    Politeness delay between NIH requests that adapts to the server
+    
+    Shrinks toward `floor` after each successful request and grows
+    (with jitter) toward `cap` when NIH throttles us (403/429) or times out.
+    """
+    
+    def __init__(self, initial=3.0, floor=1.0, cap=60.0, jitter=0.25):
+        self.current = initial
+        self.floor = floor
+        self.cap = cap
+        self.jitter = jitter
+    
+    def success(self):
+        self.current = max(self.floor, self.current * 0.9)
+    
+    def throttled(self):
+        self.current = min(self.cap, self.current * 2 * (1 + random.uniform(0, self.jitter)))
+    
+    def wait(self):
+        time.sleep(self.current)
+
+# Shared across queries so the learned pace carries over between subsections
+PACER = AdaptiveDelay()
+
+def _cache_conn():
+    """Open (once) the on-disk SQLite cache of NIH search result pages"""
+    global _CACHE_CONN
+    if _CACHE_CONN is None:
+        os.makedirs(os.path.dirname(CACHE_DB), exist_ok=True)
+        _CACHE_CONN = sqlite3.connect(CACHE_DB)
+        _CACHE_CONN.execute(
+            "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body TEXT, ts INTEGER)"
+        )
+    return _CACHE_CONN
+
+def _cache_get(url):
+    """Return the cached page body for url, or None if missing/expired"""
+    row = _cache_conn().execute(
+        "SELECT body, ts FROM responses WHERE url = ?", (url,)
+    ).fetchone()
+    if row is None or time.time() - row[1] > CACHE_TTL:
+        return None
+    return row[0]
+
+def _cache_put(url, body):
+    conn = _cache_conn()
+    conn.execute(
+        "INSERT OR REPLACE INTO responses (url, body, ts) VALUES (?, ?, ?)",
+        (url, body, int(time.time()))
+    )
+    conn.commit()
+
+def parse_search_results(html, limit=10):
+    """
+    Parse an NIH Visuals Online search result page
+    
+    Args:
+        html: Raw HTML of the search result page
+        limit: Maximum number of results to return
+        
+    Returns:
+        List of dicts with image info: {title, url, thumbnail, image_id}
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    # Find result containers
+    containers = soup.find_all("div", class_="resultsitempic")
+    
+    results = []
+    for idx, container in enumerate(containers[:limit], 1):
+        try:
+            img_tag = container.find("img")
+            link_tag = container.find("a")
+            
+            if not img_tag or not link_tag:
+                continue
+            
+            # Get image URL and detail URL
+            thumbnail = img_tag.get("src", "")
+            if thumbnail and not thumbnail.startswith("http"):
+                thumbnail = BASE_URL + thumbnail.lstrip("/")
+            
+            detail_url = link_tag.get("href", "")
+            if detail_url and not detail_url.startswith("http"):
+                detail_url = BASE_URL + detail_url.lstrip("/")
+            
+            # Extract image ID from detail URL
+            image_id = ""
+            match = re.search(r"imageid=(\d+)", detail_url)
+            if match:
+                image_id = match.group(1)
+            
+            title = img_tag.get("alt", f"Image {idx}")
+            
+            results.append({
+                "title": title,
+                "detail_url": detail_url,
+                "thumbnail": thumbnail,
+                "image_id": image_id,
+                "rank": idx
+            })
+            
+        except Exception as e:
+            print(f"  ⚠️  Error parsing result {idx}: {e}")
+            continue
+    
+    return results
+
+def search_nih_by_query(query, limit=10, pacer=None, use_cache=True):
     """
     Search NIH Visuals Online for a given query
     
     Args:
         query: Search query string
         limit: Maximum number of results to return
-        delay: Seconds to wait before returning (to be respectful)
+        pacer: AdaptiveDelay controlling waits between requests (default: PACER)
+        use_cache: Serve repeat queries from the local HTTP cache
         
     Returns:
         List of dicts with image info: {title, url, thumbnail, image_id}
@@ -35,6 +169,13 @@ def search_nih_by_query(query, limit=10, delay=5):
     encoded_query = quote_plus(query[:200])  # Limit query length
     search_url = f"{BASE_URL}searchaction.cfm?q={encoded_query}&sort=relevance"
     
+    # Cache hit: no network round trip, so no need to wait either
+    if use_cache:
+        cached = _cache_get(search_url)
+        if cached is not None:
+            print("  💾 Served from cache")
+            return parse_search_results(cached, limit)
+    
     # Vary user agents to avoid detection
     user_agents = [
         'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -42,28 +183,25 @@ def search_nih_by_query(query, limit=10, delay=5):
         'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
     ]
     
-    headers = {
-        'User-Agent': random.choice(user_agents),
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Connection': 'keep-alive',
-    }
+    headers = {'User-Agent': random.choice(user_agents)}
+    
+    if pacer is None:
+        pacer = PACER
     
-    # Retry logic with exponential backoff
+    # Retry logic with adaptive backoff
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            # Add delay before request
+            # Wait out the (possibly grown) delay before retrying
             if attempt > 0:
-                wait_time = delay * (2 ** attempt) + random.uniform(1, 3)
-                print(f"  ⏳ Retry {attempt + 1}/{max_retries}, waiting {wait_time:.1f}s...")
-                time.sleep(wait_time)
+                print(f"  ⏳ Retry {attempt + 1}/{max_retries}, waiting {pacer.current:.1f}s...")
+                pacer.wait()
             
-            response = requests.get(search_url, headers=headers, timeout=45)
+            response = SESSION.get(search_url, headers=headers, timeout=45)
             
-            if response.status_code == 403:
-                print(f"  ⚠️  Got 403 Forbidden (attempt {attempt + 1}/{max_retries})")
+            if response.status_code in (403, 429):
+                print(f"  ⚠️  Got {response.status_code} (attempt {attempt + 1}/{max_retries})")
+                pacer.throttled()
                 if attempt < max_retries - 1:
                     continue
                 return []
@@ -74,56 +212,20 @@ def search_nih_by_query(query, limit=10, delay=5):
                     continue
                 return []
             
-            soup = BeautifulSoup(response.text, 'html.parser')
+            if use_cache:
+                _cache_put(search_url, response.text)
             
-            # Find result containers
-            containers = soup.find_all("div", class_="resultsitempic")
-            
-            results = []
-            for idx, container in enumerate(containers[:limit], 1):
-                try:
-                    img_tag = container.find("img")
-                    link_tag = container.find("a")
-                    
-                    if not img_tag or not link_tag:
-                        continue
-                    
-                    # Get image URL and detail URL
-                    thumbnail = img_tag.get("src", "")
-                    if thumbnail and not thumbnail.startswith("http"):
-                        thumbnail = BASE_URL + thumbnail.lstrip("/")
-                    
-                    detail_url = link_tag.get("href", "")
-                    if detail_url and not detail_url.startswith("http"):
-                        detail_url = BASE_URL + detail_url.lstrip("/")
-                    
-                    # Extract image ID from detail URL
-                    image_id = ""
-                    match = re.search(r"imageid=(\d+)", detail_url)
-                    if match:
-                        image_id = match.group(1)
-                    
-                    title = img_tag.get("alt", f"Image {idx}")
-                    
-                    results.append({
-                        "title": title,
-                        "detail_url": detail_url,
-                        "thumbnail": thumbnail,
-                        "image_id": image_id,
-                        "rank": idx
-                    })
-                    
-                except Exception as e:
-                    print(f"  ⚠️  Error parsing result {idx}: {e}")
-                    continue
+            results = parse_search_results(response.text, limit)
             
-            # Be respectful - add delay
-            time.sleep(delay + random.uniform(1, 3))
+            # Be respectful - wait, but less as long as NIH keeps answering
+            pacer.success()
+            pacer.wait()
             
             return results
             
         except requests.exceptions.Timeout:
             print(f"  ⏰ Timeout (attempt {attempt + 1}/{max_retries})")
+            pacer.throttled()
             if attempt < max_retries - 1:
                 continue
             return []
@@ -136,7 +238,7 @@ def search_nih_by_query(query, limit=10, delay=5):
     
     return []
 
-def search_all_subsections(subsection_csv, images_per_subsection=10, output_csv=None):
+def search_all_subsections(subsection_csv, images_per_subsection=10, output_csv=None, use_cache=True):
     """
     Search NIH for all subsections and create image mapping
     
@@ -144,6 +246,7 @@ def search_all_subsections(subsection_csv, images_per_subsection=10, output_csv=
         subsection_csv: CSV with subsection queries
         images_per_subsection: Max images to retrieve per subsection
         output_csv: Output file path
+        use_cache: Reuse cached NIH search pages for repeated queries
         
     Returns:
         DataFrame with subsection-image mappings
@@ -159,60 +262,80 @@ def search_all_subsections(subsection_csv, images_per_subsection=10, output_csv=
     print(f"Images per subsection: {images_per_subsection}")
     print("=" * 70 + "\n")
     
-    all_mappings = []
-    
-    for idx, row in df_queries.iterrows():
-        chapter_id = row['chapter_id']
-        subsection_id = row['subsection_id']
-        subsection_name = row['subsection_name']
-        query = row['query_final']
-        
-        print(f"[{idx+1}/{len(df_queries)}] {subsection_name}")
-        print(f"  Query: {query[:100]}...")
-        
-        # Search NIH
-        results = search_nih_by_query(query, limit=images_per_subsection, delay=random.uniform(2, 4))
-        
-        if not results:
-            print(f"  ⚠️  No results found")
-            continue
-        
-        print(f"  ✅ Found {len(results)} images")
-        
-        # Create mappings
-        for result in results:
-            mapping = {
-                'chapter_id': chapter_id,
-                'subsection_id': subsection_id,
-                'subsection_name': subsection_name,
-                'query': query[:500],  # Truncate long queries
-                'picked_title': result['title'],
-                'detail_url': result['detail_url'],
-                'thumbnail': result['thumbnail'],
-                'image_id': result['image_id'],
-                'rank': result['rank'],
-                'candidate_count': len(results)
-            }
-            all_mappings.append(mapping)
-    
-    # Create DataFrame
-    df_mappings = pd.DataFrame(all_mappings)
-    
-    # Save to CSV
+    # Stream each subsection's rows to disk as soon as they are found, so a
+    # crash mid-run keeps everything searched so far
+    out_f = None
+    writer = None
     if output_csv:
         os.makedirs(os.path.dirname(output_csv) if os.path.dirname(output_csv) else '.', exist_ok=True)
-        df_mappings.to_csv(output_csv, index=False)
-        
-        print("\n" + "=" * 70)
-        print("✅ SEARCH COMPLETE")
-        print("=" * 70)
-        print(f"Total subsections searched: {len(df_queries)}")
-        print(f"Total images found: {len(df_mappings)}")
-        print(f"Average images per subsection: {len(df_mappings)/len(df_queries):.1f}")
-        print(f"\n📁 Saved to: {output_csv}")
-        print("=" * 70 + "\n")
-    
-    return df_mappings
+        out_f = open(output_csv, 'w', newline='', encoding='utf-8')
+        writer = csv.DictWriter(out_f, fieldnames=MAPPING_COLUMNS)
+        writer.writeheader()
+    
+    all_mappings = []  # Only kept in memory when there is no output file
+    total_images = 0
+    
+    columns = ['chapter_id', 'subsection_id', 'subsection_name', 'query_final']
+    rows = df_queries[columns].itertuples(index=False, name=None)
+    
+    try:
+        for idx, (chapter_id, subsection_id, subsection_name, query) in enumerate(rows):
+            print(f"[{idx+1}/{len(df_queries)}] {subsection_name}")
+            print(f"  Query: {query[:100]}...")
+            
+            # Search NIH
+            results = search_nih_by_query(
+                query,
+                limit=images_per_subsection,
+                use_cache=use_cache
+            )
+            
+            if not results:
+                print(f"  ⚠️  No results found")
+                continue
+            
+            print(f"  ✅ Found {len(results)} images")
+            
+            # Create mappings
+            mappings = []
+            for result in results:
+                mapping = {
+                    'chapter_id': chapter_id,
+                    'subsection_id': subsection_id,
+                    'subsection_name': subsection_name,
+                    'query': query[:500],  # Truncate long queries
+                    'picked_title': result['title'],
+                    'detail_url': result['detail_url'],
+                    'thumbnail': result['thumbnail'],
+                    'image_id': result['image_id'],
+                    'rank': result['rank'],
+                    'candidate_count': len(results)
+                }
+                mappings.append(mapping)
+            
+            total_images += len(mappings)
+            if writer:
+                writer.writerows(mappings)
+                out_f.flush()
+            else:
+                all_mappings.extend(mappings)
+    finally:
+        if out_f:
+            out_f.close()
+    
+    if not output_csv:
+        return pd.DataFrame(all_mappings, columns=MAPPING_COLUMNS)
+    
+    print("\n" + "=" * 70)
+    print("✅ SEARCH COMPLETE")
+    print("=" * 70)
+    print(f"Total subsections searched: {len(df_queries)}")
+    print(f"Total images found: {total_images}")
+    print(f"Average images per subsection: {total_images/len(df_queries):.1f}")
+    print(f"\n📁 Saved to: {output_csv}")
+    print("=" * 70 + "\n")
+    
+    return pd.read_csv(output_csv)
 
 def main():
     import argparse
@@ -240,6 +363,11 @@ def main():
         default=10,
         help='Maximum images per subsection (default: 10)'
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always query NIH instead of reusing cached search pages'
+    )
     
     args = parser.parse_args()
     
@@ -264,7 +392,8 @@ def main():
     df_mappings = search_all_subsections(
         args.subsection_csv,
         images_per_subsection=args.limit,
-        output_csv=args.output
+        output_csv=args.output,
+        use_cache=not args.no_cache
     )
     
     # Show sample results
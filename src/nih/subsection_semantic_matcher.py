@@ -20,6 +20,10 @@ Usage:
 
 import os
 import re
+import sys
+import csv
+import hashlib
+import numpy as np
 import pandas as pd
 import torch
 from tqdm import tqdm
@@ -27,15 +31,43 @@ from sentence_transformers import SentenceTransformer, util
 import argparse
 import pickle
 
+# ONNX Runtime exports shipped in the model repo (shared with src/utils/model_loader.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from model_loader import ONNX_FILES
+
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+QUERY_CACHE_DIR = "data/.query_emb_cache"
+
+MATCH_COLUMNS = [
+    'chapter_id', 'subsection_id', 'subsection_name', 'query', 'picked_title',
+    'detail_url', 'thumbnail', 'image_id', 'match_score', 'candidate_count', 'rank'
+]
+
+def load_model(device, backend="torch"):
+    """
+    Load the MiniLM encoder on the given backend
+    
+    Args:
+        device: Torch device (only used by the torch backend)
+        backend: "torch" (eager PyTorch), "onnx" or "onnx-int8" (ONNX Runtime, CPU)
+    """
+    if backend == "torch":
+        return SentenceTransformer(MODEL_NAME, device=device)
+    return SentenceTransformer(
+        MODEL_NAME,
+        device="cpu",
+        backend="onnx",
+        model_kwargs={"file_name": ONNX_FILES[backend], "provider": "CPUExecutionProvider"}
+    )
 
-def create_nih_embeddings(metadata_csv, embeddings_file):
+def create_nih_embeddings(metadata_csv, embeddings_file, backend="torch"):
     """
     Create and save embeddings for all NIH images (one-time setup)
     
     Args:
         metadata_csv: CSV with NIH image metadata (from attribution scraper)
         embeddings_file: Where to save the embeddings
+        backend: Encoder backend ("torch", "onnx" or "onnx-int8")
     """
     
     print("\n" + "=" * 70)
@@ -55,8 +87,8 @@ def create_nih_embeddings(metadata_csv, embeddings_file):
     
     # Load model
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Device: {device}")
-    model = SentenceTransformer(MODEL_NAME, device=device)
+    print(f"Device: {device} | Backend: {backend}")
+    model = load_model(device, backend)
     
     # Generate embeddings
     print("\n⚙️ Generating embeddings...")
@@ -86,12 +118,48 @@ def create_nih_embeddings(metadata_csv, embeddings_file):
     print(f"\n✅ Saved embeddings for {len(df)} images to: {embeddings_file}")
     print("=" * 70 + "\n")
 
+def encode_queries(queries, chapter_id, device, cache_dir=QUERY_CACHE_DIR, backend="torch"):
+    """
+    Encode subsection queries in a single batch, reusing a cached copy if present
+    
+    The cache file is keyed by chapter and a hash of the model + query texts,
+    so re-running with different --min-score/--topk skips the model entirely.
+    
+    Args:
+        queries: List of query strings
+        chapter_id: Chapter the queries belong to (used in the cache filename)
+        device: Torch device for the returned tensor
+        cache_dir: Cache directory (None disables caching)
+        backend: Encoder backend ("torch", "onnx" or "onnx-int8")
+        
+    Returns:
+        Tensor of shape (len(queries), dim)
+    """
+    cache_path = None
+    if cache_dir:
+        key = hashlib.sha1((MODEL_NAME + '\n' + backend + '\n' + '\n'.join(queries)).encode()).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, f"{chapter_id}_{key}.npy")
+        if os.path.exists(cache_path):
+            print(f"💾 Loaded cached query embeddings: {cache_path}")
+            return torch.from_numpy(np.load(cache_path)).to(device)
+    
+    model = load_model(device, backend)
+    query_embs = model.encode(queries, convert_to_tensor=True, batch_size=32).to(device)
+    
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_path, query_embs.cpu().numpy())
+    
+    return query_embs
+
 def match_subsections_to_images(
     subsection_csv,
     embeddings_file,
     output_csv,
     min_score=0.7,
-    topk=10
+    topk=10,
+    query_cache_dir=QUERY_CACHE_DIR,
+    backend="torch"
 ):
     """
     Match subsections to NIH images using semantic similarity
@@ -102,6 +170,8 @@ def match_subsections_to_images(
         output_csv: Output file with matches
         min_score: Minimum similarity threshold
         topk: Maximum images per subsection
+        query_cache_dir: Where to cache query embeddings (None disables)
+        backend: Encoder backend ("torch", "onnx" or "onnx-int8")
     """
     
     print("\n" + "=" * 70)
@@ -111,6 +181,9 @@ def match_subsections_to_images(
     # Load subsection queries
     subsections_df = pd.read_csv(subsection_csv)
     print(f"Subsections: {len(subsections_df)}")
+    if subsections_df.empty:
+        print("\n⚠️ No matches found! The subsection CSV has no rows")
+        return pd.DataFrame(columns=MATCH_COLUMNS)
     
     # Load NIH embeddings
     print(f"Loading embeddings from: {embeddings_file}")
@@ -122,80 +195,84 @@ def match_subsections_to_images(
     print(f"Top-K per subsection: {topk}")
     print("=" * 70 + "\n")
     
-    # Load model
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = SentenceTransformer(MODEL_NAME, device=device)
+    
+    # Encode all subsection queries in one batch (cached on disk by content hash)
+    queries = subsections_df['query_final'].astype(str).tolist()
+    query_embs = encode_queries(
+        queries, subsections_df['chapter_id'].iloc[0], device, query_cache_dir, backend
+    )
     
     # Get NIH embeddings
     nih_embeddings = nih_data['embeddings'].to(device)
     
-    # Match each subsection
-    all_matches = []
+    # Match each subsection, streaming rows to disk as they are produced
     global_best = {}  # Track best score for each image globally
+    total_matches = 0
     
-    for idx, row in tqdm(subsections_df.iterrows(), total=len(subsections_df), desc="Matching subsections"):
-        chapter_id = row['chapter_id']
-        subsection_id = row['subsection_id']
-        subsection_name = row['subsection_name']
-        query_text = row['query_final']
-        
-        # Generate embedding for this subsection
-        subsection_emb = model.encode(query_text, convert_to_tensor=True)
-        
-        # Calculate similarities
-        similarities = util.cos_sim(subsection_emb, nih_embeddings)[0]
-        
-        # Get top matches
-        top_results = torch.topk(similarities, k=min(topk * 2, len(similarities)))  # Get extra for filtering
+    columns = ['chapter_id', 'subsection_id', 'subsection_name', 'query_final']
+    rows = subsections_df[columns].itertuples(index=False, name=None)
+    
+    os.makedirs(os.path.dirname(output_csv) if os.path.dirname(output_csv) else '.', exist_ok=True)
+    with open(output_csv, 'w', newline='', encoding='utf-8') as out_f:
+        writer = csv.DictWriter(out_f, fieldnames=MATCH_COLUMNS)
+        writer.writeheader()
         
-        # Process matches
-        subsection_matches = []
-        for score, img_idx in zip(top_results.values, top_results.indices):
-            score_val = float(score)
-            
-            # Skip if below threshold
-            if score_val < min_score:
-                continue
+        for i, (chapter_id, subsection_id, subsection_name, query_text) in enumerate(tqdm(rows, total=len(subsections_df), desc="Matching subsections")):
+            subsection_emb = query_embs[i]
             
-            img_idx = int(img_idx)
-            image_id = nih_data['image_ids'][img_idx]
+            # Calculate similarities
+            similarities = util.cos_sim(subsection_emb, nih_embeddings)[0]
             
-            # Deduplication: check if we've seen this image with better score
-            if image_id in global_best and score_val < global_best[image_id] + 0.05:
-                continue
+            # Get top matches
+            top_results = torch.topk(similarities, k=min(topk * 2, len(similarities)))  # Get extra for filtering
             
-            match = {
-                'chapter_id': chapter_id,
-                'subsection_id': subsection_id,
-                'subsection_name': subsection_name,
-                'query': query_text[:500],
-                'picked_title': nih_data['titles'][img_idx],
-                'detail_url': nih_data['detail_urls'][img_idx],
-                'thumbnail': nih_data['thumbnails'][img_idx],
-                'image_id': image_id,
-                'match_score': round(score_val, 4),
-                'candidate_count': len(nih_data['image_ids']),
-                'rank': len(subsection_matches) + 1
-            }
+            # Process matches
+            subsection_matches = []
+            for score, img_idx in zip(top_results.values, top_results.indices):
+                score_val = float(score)
+                
+                # Skip if below threshold
+                if score_val < min_score:
+                    continue
+                
+                img_idx = int(img_idx)
+                image_id = nih_data['image_ids'][img_idx]
+                
+                # Deduplication: check if we've seen this image with better score
+                if image_id in global_best and score_val < global_best[image_id] + 0.05:
+                    continue
+                
+                match = {
+                    'chapter_id': chapter_id,
+                    'subsection_id': subsection_id,
+                    'subsection_name': subsection_name,
+                    'query': query_text[:500],
+                    'picked_title': nih_data['titles'][img_idx],
+                    'detail_url': nih_data['detail_urls'][img_idx],
+                    'thumbnail': nih_data['thumbnails'][img_idx],
+                    'image_id': image_id,
+                    'match_score': round(score_val, 4),
+                    'candidate_count': len(nih_data['image_ids']),
+                    'rank': len(subsection_matches) + 1
+                }
+                
+                subsection_matches.append(match)
+                global_best[image_id] = score_val
+                
+                # Stop when we have enough
+                if len(subsection_matches) >= topk:
+                    break
             
-            subsection_matches.append(match)
-            global_best[image_id] = score_val
-            
-            # Stop when we have enough
-            if len(subsection_matches) >= topk:
-                break
-        
-        all_matches.extend(subsection_matches)
+            writer.writerows(subsection_matches)
+            out_f.flush()
+            total_matches += len(subsection_matches)
     
-    # Save results
-    df_matches = pd.DataFrame(all_matches)
-    
-    if len(df_matches) == 0:
+    if total_matches == 0:
         print("\n⚠️ No matches found! Try lowering --min-score")
-        return
+        return pd.DataFrame(columns=MATCH_COLUMNS)
     
-    os.makedirs(os.path.dirname(output_csv), exist_ok=True)
-    df_matches.to_csv(output_csv, index=False)
+    df_matches = pd.read_csv(output_csv)
     
     print("\n" + "=" * 70)
     print("✅ MATCHING COMPLETE")
@@ -214,6 +291,8 @@ def match_subsections_to_images(
         print(f"  {sub_id}. {sub_name[:50]}: {count} images (avg score: {avg_score:.3f})")
     
     print("=" * 70 + "\n")
+    
+    return df_matches
 
 def main():
     parser = argparse.ArgumentParser(
@@ -259,12 +338,18 @@ def main():
         default=10,
         help='Max images per subsection (default: 10)'
     )
+    parser.add_argument(
+        '--backend',
+        choices=['torch', 'onnx', 'onnx-int8'],
+        default='torch',
+        help='Encoder backend; onnx/onnx-int8 run on CPU via ONNX Runtime, needs sentence-transformers[onnx] (default: torch)'
+    )
     
     args = parser.parse_args()
     
     # Mode 1: Create embeddings
     if args.create_embeddings:
-        create_nih_embeddings(args.metadata_csv, args.embeddings_file)
+        create_nih_embeddings(args.metadata_csv, args.embeddings_file, args.backend)
         return
     
     # Mode 2: Match subsections
@@ -299,7 +384,8 @@ def main():
         args.embeddings_file,
         args.output,
         args.min_score,
-        args.topk
+        args.topk,
+        backend=args.backend
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+# src/utils/dataset.py
+"""
+Shared loader for the preprocessed chapters dataset.
+
+data_preprocessing.py writes data/chapters_dataset.csv. The first read converts
+it to Parquet (chapter_id stored as a categorical), and later reads push the
+chapter filter down to the Parquet file instead of re-parsing the whole CSV.
+The Parquet copy is rebuilt whenever the CSV is newer.
+"""
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+
+CSV_FILE = "data/chapters_dataset.csv"
+PARQUET_FILE = "data/chapters_dataset.parquet"
+
+
+def ensure_parquet(csv_file=CSV_FILE, parquet_file=PARQUET_FILE):
+    """Convert the chapters CSV to Parquet if missing or stale; return its path."""
+    stale = (
+        not os.path.exists(parquet_file)
+        or (os.path.exists(csv_file) and os.path.getmtime(csv_file) > os.path.getmtime(parquet_file))
+    )
+    if stale:
+        df = pd.read_csv(csv_file, dtype={"chapter_id": str})
+        df = df.astype({"chapter_id": "category"})
+        df.to_parquet(parquet_file, index=False)
+    return parquet_file
+
+
+def load_chapters(chapter_id=None, csv_file=CSV_FILE, parquet_file=PARQUET_FILE):
+    """
+    Load paragraphs for one chapter (or all chapters if chapter_id is None).
+    Returns a DataFrame with chapter_id, paragraph_id, text.
+    """
+    path = ensure_parquet(csv_file, parquet_file)
+    filters = [("chapter_id", "=", str(chapter_id))] if chapter_id is not None else None
+    return pq.read_table(path, filters=filters).to_pandas()
+
+
+def list_chapter_ids(csv_file=CSV_FILE, parquet_file=PARQUET_FILE):
+    """Return the sorted list of chapter IDs (reads only the chapter_id column)."""
+    path = ensure_parquet(csv_file, parquet_file)
+    ids = pq.read_table(path, columns=["chapter_id"]).to_pandas()["chapter_id"]
+    return sorted(ids.astype(str).unique())
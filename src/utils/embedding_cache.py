@@ -0,0 +1,106 @@
+# src/utils/embedding_cache.py
+"""
+Content-addressed on-disk cache for sentence embeddings.
+
+Every vector is keyed by blake2b(model_name + "\0" + text) and stored as fp16
+in a small SQLite file, so re-running a chapter (or a chapter that shares text
+with one already processed) only encodes texts that were never seen before.
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+import torch
+
+CACHE_DB = "data/embedding_cache.sqlite"
+_SQL_CHUNK = 500  # keys per SELECT ... IN (...) (SQLite variable limit)
+
+_conns = {}
+_lock = threading.Lock()
+
+
+def _key(model_name: str, text: str) -> bytes:
+    return hashlib.blake2b(f"{model_name}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+
+def _cache(db_path: str = CACHE_DB):
+    conn = _conns.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB)")
+        _conns[db_path] = conn
+    return conn
+
+
+def get_or_compute_many(texts, model_name: str, compute, db_path: str = CACHE_DB):
+    """
+    Return a float32 array of shape (len(texts), dim) in input order.
+    Cached vectors are read from disk; the misses are passed to compute(list)
+    in a single call and written back as fp16.
+    """
+    texts = list(texts)
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    keys = [_key(model_name, t) for t in texts]
+
+    found = {}
+    with _lock:
+        conn = _cache(db_path)
+        uniq = list(dict.fromkeys(keys))
+        for i in range(0, len(uniq), _SQL_CHUNK):
+            part = uniq[i:i + _SQL_CHUNK]
+            rows = conn.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+            ).fetchall()
+            found.update((k, np.frombuffer(v, dtype=np.float16)) for k, v in rows)
+
+    miss = [i for i, k in enumerate(keys) if k not in found]
+    if miss:
+        computed = np.asarray(compute([texts[i] for i in miss]), dtype=np.float32).astype(np.float16)
+        with _lock:
+            conn = _cache(db_path)
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                [(keys[i], vec.tobytes()) for i, vec in zip(miss, computed)]
+            )
+            conn.commit()
+        found.update((keys[i], vec) for i, vec in zip(miss, computed))
+
+    return np.stack([found[k] for k in keys]).astype(np.float32)
+
+
+def cached_encode(model, texts, model_name: str, backend: str = "torch", use_cache: bool = True,
+                  **encode_kwargs):
+    """
+    Drop-in for model.encode(texts, convert_to_tensor=True) with the disk cache
+    in front. Returns a float32 tensor on the model's device.
+    Each backend (torch / onnx / onnx-int8), normalized and raw embeddings, and
+    different truncation lengths are cached under separate keys.
+    """
+    encode_kwargs.pop("convert_to_tensor", None)
+    model_name = f"{model_name}|{backend}"
+    if getattr(model, "max_seq_length", None):
+        model_name = f"{model_name}|len={model.max_seq_length}"
+    if encode_kwargs.get("normalize_embeddings"):
+        model_name = f"{model_name}|normalized"
+    encode = lambda batch: model.encode(batch, convert_to_numpy=True, **encode_kwargs)
+
+    # Repeated texts (headings, boilerplate captions) are encoded once and
+    # fanned back out to every position. No length sort is needed here:
+    # model.encode already orders its inputs by length and pads each batch
+    # only to its longest member (SBERT smart batching)
+    texts = list(texts)
+    index = {}
+    inverse = np.fromiter(
+        (index.setdefault(t, len(index)) for t in texts), dtype=np.int64, count=len(texts)
+    )
+    unique_texts = list(index)
+
+    if use_cache:
+        embs = get_or_compute_many(unique_texts, model_name, encode)
+    else:
+        embs = encode(unique_texts)
+    embs = np.asarray(embs, dtype=np.float32)[inverse]
+    return torch.from_numpy(embs).to(model.device)
@@ -1,25 +1,29 @@
 from bs4 import BeautifulSoup
+from lxml import etree
 import os
 
 # Read the first HTML file we saved
 html_file = "data/html_cache/12496.html"
 
+# Only this much of the file is parsed into a DOM (title lookups, previews)
+HEAD_BYTES = 8192
+
 if not os.path.exists(html_file):
     print(f"File not found: {html_file}")
     print("\nAvailable files:")
     for f in os.listdir("data/html_cache/")[:5]:
         print(f"  - {f}")
 else:
-    with open(html_file, "r", encoding="utf-8") as f:
-        html = f.read()
+    with open(html_file, "rb") as f:
+        head = f.read(HEAD_BYTES).decode("utf-8", errors="ignore")
     
-    print(f"HTML file size: {len(html)} characters")
+    print(f"HTML file size: {os.path.getsize(html_file)} bytes")
     print("=" * 70)
     
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(head, 'lxml')
     
     # Check for common title locations
-    print("\n🔍 Looking for TITLE:")
+    print(f"\n🔍 Looking for TITLE (first {HEAD_BYTES // 1024} KB):")
     print("-" * 70)
     if soup.find('title'):
         print(f"<title> tag: {soup.find('title').get_text(strip=True)}")
@@ -36,14 +40,20 @@ else:
             print(f"  Class: {div.get('class')}")
             print(f"  Text: {div.get_text(strip=True)[:100]}")
     
-    # Show all unique div classes
+    # Show all unique div classes (streamed over the whole file, no full DOM)
     print("\n" + "=" * 70)
     print("📦 ALL DIV CLASSES found in HTML:")
     print("-" * 70)
     all_classes = set()
-    for div in soup.find_all('div'):
-        if div.get('class'):
-            all_classes.update(div.get('class'))
+    with open(html_file, "rb") as f:
+        for _, el in etree.iterparse(f, events=("end",), html=True, tag="div"):
+            cls = el.get("class")
+            if cls:
+                all_classes.update(cls.split())
+            # Drop the finished subtree and the siblings already seen
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
     
     for cls in sorted(all_classes)[:30]:
         print(f"  - {cls}")
@@ -55,10 +65,10 @@ else:
     print("\n" + "=" * 70)
     print("📄 FIRST 2000 CHARACTERS OF HTML:")
     print("-" * 70)
-    print(html[:2000])
+    print(head[:2000])
     
     print("\n" + "=" * 70)
-    print("📄 ALL TEXT CONTENT (first 1000 chars):")
+    print(f"📄 ALL TEXT CONTENT (first 1000 chars of first {HEAD_BYTES // 1024} KB):")
     print("-" * 70)
     text = soup.get_text(separator=' ', strip=True)
-    print(text[:1000])
\ No newline at end of file
+    print(text[:1000])
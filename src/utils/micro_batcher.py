@@ -0,0 +1,108 @@
+# src/utils/micro_batcher.py
+"""
+Micro-batching front end for a preloaded SentenceTransformer.
+
+For per-request use (one paragraph or query at a time), calling model.encode
+per text leaves the GPU mostly idle. MicroBatcher collects single texts from
+any number of threads for up to `max_wait` seconds (or until `max_batch` are
+queued), encodes them in one call on a background thread and hands each caller
+its own vector through a Future.
+
+    batcher = MicroBatcher(model)
+    emb = batcher.encode_one("Ductal carcinoma in situ ...")
+    batcher.close()
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    def __init__(self, model, max_batch: int = 32, max_wait: float = 0.05, **encode_kwargs):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # Each batch is encoded in a single call; its size is bounded by max_batch
+        encode_kwargs.pop("batch_size", None)
+        self.encode_kwargs = {"convert_to_tensor": True, "normalize_embeddings": True, **encode_kwargs}
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()  # makes the closed check + put atomic
+        self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        """Queue one text; the Future resolves to its embedding."""
+        fut = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self._queue.put((text, fut))
+        return fut
+
+    def encode_one(self, text: str):
+        """Blocking helper: embedding for a single text, batched with concurrent callers."""
+        return self.submit(text).result()
+
+    def close(self):
+        """Flush pending texts and stop the worker thread."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            # Never leave a caller blocked on a Future nobody will resolve
+            with self._lock:
+                self._closed = True
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None and item[1].set_running_or_notify_cancel():
+                    item[1].set_exception(RuntimeError("MicroBatcher is closed"))
+
+    def _loop(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Collect more texts until the batch is full or the window closes
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while len(batch) < self.max_batch:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+            except queue.Empty:
+                pass
+
+            # Skip texts whose caller already cancelled the Future
+            batch = [(t, fut) for t, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            texts = [t for t, _ in batch]
+            try:
+                embs = self.model.encode(texts, batch_size=len(texts), **self.encode_kwargs)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), emb in zip(batch, embs):
+                fut.set_result(emb)
@@ -0,0 +1,45 @@
+# src/utils/model_loader.py
+"""
+Shared SentenceTransformer loader for the matching scripts.
+
+Models are cached per process by (model name, backend). Because the cache
+lives in this importable module, joblib workers keep their loaded model
+across chapters instead of receiving a fresh copy with every task.
+"""
+import torch
+from sentence_transformers import SentenceTransformer
+
+# ONNX Runtime exports shipped with all-MiniLM-L6-v2 (need `sentence-transformers[onnx]`);
+# other models are exported to fp32 ONNX on first load
+ONNX_FILES = {
+    "onnx": "onnx/model_O3.onnx",                      # graph-optimized fp32
+    "onnx-int8": "onnx/model_qint8_avx512_vnni.onnx",  # dynamic int8 (AVX-512 VNNI)
+}
+
+_MODELS = {}
+
+
+def get_model(model_name: str, backend: str = "torch", max_seq_length: int = None):
+    """
+    Load a SentenceTransformer once per process.
+    torch: PyTorch (GPU + fp16 when CUDA is available)
+    onnx / onnx-int8: ONNX Runtime on CPU
+    """
+    model = _MODELS.get((model_name, backend))
+    if model is None:
+        if backend != "torch":
+            model_kwargs = {"provider": "CPUExecutionProvider"}
+            if model_name == "all-MiniLM-L6-v2":
+                model_kwargs["file_name"] = ONNX_FILES[backend]
+            elif backend == "onnx-int8":
+                print(f"⚠️ No int8 export ships with {model_name}; using fp32 ONNX")
+            model = SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+        else:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model = SentenceTransformer(model_name, device=device)
+            if device == "cuda":
+                model.half()  # fp16 weights: ~2x encode throughput on GPU
+        _MODELS[(model_name, backend)] = model
+    if max_seq_length:
+        model.max_seq_length = max_seq_length
+    return model
@@ -1,15 +1,31 @@
 # src/parse_metadata.py
-import os, re, csv
-from bs4 import BeautifulSoup
+import os, re, csv, html
+from concurrent.futures import ProcessPoolExecutor
 
 CACHE_DIR = "cache/html"
 OUT_FILE = "data/image_metadata_fixed.csv"
 
+# Detail pages are a flat list of "<p>Field: value</p>" entries, so a regex
+# over the raw HTML is enough - no need to build a DOM per file.
+# A paragraph ends at </p>, or implicitly at the next <p> or the end of its block.
+P_RE = re.compile(r"<p\b[^>]*>(.*?)(?=</?p\b|</(?:div|td|li|body)\b)", re.S | re.I)
+TAG_RE = re.compile(r"<[^>]+>")
+FIELDS = {
+    "Title:": "title",
+    "Description:": "description",
+    "Source:": "source",
+    "Reuse Restrictions:": "license",
+}
+
+# Case-insensitive patterns avoid lowercasing a copy of the text per call.
+# Public domain / NCI takes precedence over Creative Commons wherever it appears.
+PUBLIC_RE = re.compile(r"nci|national cancer institute|public domain", re.I)
+CC_RE = re.compile(r"creative commons|cc by", re.I)
+
 def classify_license(text):
-    t = text.lower()
-    if any(x in t for x in ["nci", "national cancer institute", "public domain"]):
+    if PUBLIC_RE.search(text):
         return "Public Domain / NCI"
-    elif "creative commons" in t or "cc by" in t:
+    elif CC_RE.search(text):
         return "Creative Commons"
     else:
         return "Restricted / Needs Review"
@@ -19,34 +35,30 @@ def parse_html(image_id):
     if not os.path.exists(path):
         return None
     with open(path, encoding="utf-8") as f:
-        soup = BeautifulSoup(f, "html.parser")
+        raw = f.read()
 
     data = {"image_id": image_id, "title": "", "description": "", "source": "", "license": ""}
-    for p in soup.find_all("p"):
-        text = p.get_text(strip=True)
-        if text.startswith("Title:"):
-            data["title"] = text.replace("Title:", "").strip()
-        elif text.startswith("Description:"):
-            data["description"] = text.replace("Description:", "").strip()
-        elif text.startswith("Source:"):
-            data["source"] = text.replace("Source:", "").strip()
-        elif text.startswith("Reuse Restrictions:"):
-            data["license"] = text.replace("Reuse Restrictions:", "").strip()
-
-    combo = " ".join(data.values()).lower()
+    for inner in P_RE.findall(raw):
+        # Same text as BeautifulSoup's get_text(strip=True): each text node is
+        # stripped and the pieces are joined with no separator
+        text = "".join(html.unescape(part).strip() for part in TAG_RE.split(inner))
+        for prefix, key in FIELDS.items():
+            if text.startswith(prefix):
+                data[key] = text[len(prefix):].strip()
+                break
+
+    combo = " ".join(data.values())
     data["license_class"] = classify_license(combo)
     data["attribution"] = f"{data['title']} — Source: {data['source'] or 'NCI'}, {data['license_class']}."
     return data
 
 def main():
-    image_ids = [re.sub(r"\.html$", "", f) for f in os.listdir(CACHE_DIR) if f.endswith(".html")]
+    with os.scandir(CACHE_DIR) as it:
+        image_ids = [e.name.removesuffix(".html") for e in it if e.name.endswith(".html")]
     print(f"Parsing {len(image_ids)} cached files...")
 
-    all_data = []
-    for image_id in image_ids:
-        d = parse_html(image_id)
-        if d:
-            all_data.append(d)
+    with ProcessPoolExecutor() as ex:
+        all_data = [d for d in ex.map(parse_html, image_ids, chunksize=32) if d]
 
     with open(OUT_FILE, "w", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=all_data[0].keys())
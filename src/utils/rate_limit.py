@@ -0,0 +1,26 @@
+# src/utils/rate_limit.py
+"""
+Thread-safe request pacing shared by the NIH and Wikimedia fetchers.
+"""
+import time
+import threading
+
+
+class RateLimiter:
+    """
+    Callers of acquire() are released at most once every `interval` seconds,
+    shared across all fetch threads.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
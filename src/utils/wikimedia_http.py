@@ -0,0 +1,98 @@
+# src/utils/wikimedia_http.py
+"""
+Shared HTTP plumbing for the Wikimedia Commons scripts.
+
+One keep-alive session with a pooled adapter (connections are reused across
+requests and fetch threads) and a rate limiter shared by every thread, so
+concurrent searches stay within Wikimedia's API limits. Throttling (429) and
+transient server errors are retried by the adapter with exponential backoff,
+honouring Retry-After. Successful API
+responses are kept in an on-disk SQLite cache for a day, so re-running a
+chapter (or repeating a query within one) skips the network.
+"""
+import os
+import time
+import sqlite3
+import threading
+from collections import defaultdict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from rate_limit import RateLimiter
+
+REQUESTS_PER_SECOND = 10
+CACHE_DB = "data/wm_cache.sqlite"
+CACHE_TTL = 24 * 3600  # seconds
+CACHE_ENABLED = True
+
+
+SESSION = requests.Session()
+RETRY = Retry(
+    total=5,
+    backoff_factor=1.5,
+    backoff_jitter=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
+    raise_on_status=False,  # hand the final response back to the caller
+)
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=RETRY))
+LIMITER = RateLimiter(interval=1.0 / REQUESTS_PER_SECOND)
+
+
+_cache_conn = None
+_cache_lock = threading.Lock()
+_url_locks = defaultdict(threading.Lock)
+
+
+def _cache():
+    global _cache_conn
+    if _cache_conn is None:
+        os.makedirs(os.path.dirname(CACHE_DB), exist_ok=True)
+        _cache_conn = sqlite3.connect(CACHE_DB, check_same_thread=False)
+        _cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body TEXT, ts INTEGER)"
+        )
+    return _cache_conn
+
+
+def _cached_response(url, body):
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.url = url
+    resp.encoding = "utf-8"
+    resp._content = body.encode("utf-8")
+    return resp
+
+
+def get(url, params=None, **kwargs):
+    """
+    Rate-limited GET on the shared keep-alive session.
+    Responses fetched within CACHE_TTL are served from disk without touching
+    the rate limiter; concurrent requests for the same URL share one fetch.
+    """
+    if not CACHE_ENABLED:
+        LIMITER.acquire()
+        return SESSION.get(url, params=params, **kwargs)
+
+    full_url = requests.Request("GET", url, params=params).prepare().url
+    with _cache_lock:
+        url_lock = _url_locks[full_url]
+    with url_lock:
+        with _cache_lock:
+            row = _cache().execute(
+                "SELECT body, ts FROM responses WHERE url = ?", (full_url,)
+            ).fetchone()
+        if row is not None and time.time() - row[1] <= CACHE_TTL:
+            return _cached_response(full_url, row[0])
+
+        LIMITER.acquire()
+        resp = SESSION.get(full_url, **kwargs)
+        if resp.status_code == 200:
+            with _cache_lock:
+                conn = _cache()
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (url, body, ts) VALUES (?, ?, ?)",
+                    (full_url, resp.text, int(time.time()))
+                )
+                conn.commit()
+        return resp
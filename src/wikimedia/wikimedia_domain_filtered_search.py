@@ -1,15 +1,35 @@
-import os, re, time, argparse, datetime as dt
-import requests, pandas as pd
+import os, re, sys, csv, html, argparse, datetime as dt
+import numpy as np
+import pandas as pd
 from bs4 import BeautifulSoup
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer, util
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from dataset import load_chapters, list_chapter_ids
+from embedding_cache import cached_encode
+from model_loader import get_model
+import wikimedia_http
 
 API = "https://commons.wikimedia.org/w/api.php"
 
+OUTPUT_COLUMNS = [
+    "chapter_id", "paragraph_id", "query", "title", "image_url", "page_url",
+    "license", "credit", "desc", "semantic_score", "keyword_score", "final_score"
+]
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
 def clean_text(s):
     if not s:
         return ""
-    return BeautifulSoup(str(s), "html.parser").get_text(" ", strip=True)
+    s = str(s)
+    # Metadata fields are short inline HTML: strip tags with a regex and only
+    # build a DOM for structured markup (tables, lists)
+    if "<table" in s or "<ul" in s:
+        return BeautifulSoup(s, "html.parser").get_text(" ", strip=True)
+    return " ".join(html.unescape(_TAG_RE.sub(" ", s)).split())
 
 def wikimedia_search_files(query, limit=20):
     url = "https://commons.wikimedia.org/w/api.php"
@@ -26,12 +46,15 @@ def wikimedia_search_files(query, limit=20):
         "iiurlwidth": 640,
     }
     headers = {"User-Agent": "CancerTextbookAI/1.0 (contact: kalyankumar194@gmail.com)"}
-    r = requests.get(url, params=params, headers=headers, timeout=10)
-    if r.status_code == 429:
-        time.sleep(5)
-        return wikimedia_search_files(query, limit)
-    r.raise_for_status()
-    data = r.json()
+    # 429/5xx are retried with backoff by the shared session; if they still
+    # fail, skip this query instead of aborting the chapter
+    try:
+        r = wikimedia_http.get(url, params=params, headers=headers, timeout=10)
+        r.raise_for_status()
+        data = r.json()
+    except Exception as e:
+        print(f"⚠️ Wikimedia API error: {e}")
+        return []
     if "query" not in data:
         return []
     pages = data["query"]["pages"]
@@ -51,77 +74,127 @@ def wikimedia_search_files(query, limit=20):
         })
     return results
 
-def keyword_overlap_score(a, b):
-    aw, bw = set(a.lower().split()), set(b.lower().split())
-    return len(aw & bw) / max(1, len(aw | bw))
+def keyword_overlap_scores(text, descs):
+    """Jaccard token overlap between a paragraph and each candidate description."""
+    aw = set(text.lower().split())
+    bws = [set(d.lower().split()) for d in descs]
+    inter = np.fromiter((len(aw & bw) for bw in bws), dtype=np.int32, count=len(bws))
+    sizes = np.fromiter((len(bw) for bw in bws), dtype=np.int32, count=len(bws))
+    # |A u B| = |A| + |B| - |A n B|, no union sets needed
+    return inter / np.maximum(1, len(aw) + sizes - inter)
+
+_WORD_RE = re.compile(r"[A-Za-z]+")
+_STOP = frozenset({"the","and","of","to","a","in","on","for","with","by","as","from","is","are"})
 
 def build_domain_query(text):
-    base_terms = re.findall(r"[A-Za-z]+", text)
-    stop = {"the","and","of","to","a","in","on","for","with","by","as","from","is","are"}
-    words = [w for w in base_terms if w.lower() not in stop and len(w) > 2]
+    base_terms = _WORD_RE.findall(text)
+    words = [w for w in base_terms if w.lower() not in _STOP and len(w) > 2]
     core = " ".join(words[:6])
     # add biomedical focus
     domain_terms = "pathology histology tumor cancer biopsy tissue cell microscopy"
     return f"({core}) ({domain_terms})"
 
+def process_chapter(chapter_id, model_name, args):
+    """Search, score and write the matches CSV for one chapter; returns its path."""
+    wikimedia_http.CACHE_ENABLED = not args.no_cache
+    # Chapters processed in parallel share Wikimedia's request budget
+    wikimedia_http.LIMITER.interval = args.jobs / wikimedia_http.REQUESTS_PER_SECOND
+
+    df = load_chapters(chapter_id)
+    if df.empty:
+        print(f"⚠️ No rows for chapter {chapter_id}")
+        return
+
+    ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_csv = f"data/wikimedia_domain_matches_{chapter_id}_{ts}.csv"
+
+    # Paragraphs and captions are short; biobert keeps headroom for long descriptions
+    model = get_model(model_name, args.backend, max_seq_length=256 if "biobert" in model_name else 128)
+
+    # Fetch candidates for every paragraph first; paragraph p's candidates
+    # occupy descs[offset:offset + len(candidates)]
+    para_texts = df["text"].astype(str).tolist()
+
+    def fetch_for_row(row):
+        para_id, text = int(row[0]), str(row[1])
+        query = build_domain_query(text)
+        return para_id, text, query, wikimedia_search_files(query, limit=args.limit_per_para)
+
+    fetched = []
+    descs = []
+    with ThreadPoolExecutor(max_workers=args.workers) as ex:
+        results = ex.map(fetch_for_row, df[["paragraph_id", "text"]].itertuples(index=False, name=None))
+        for para_id, text, query, candidates in tqdm(results, total=len(df), desc="Wikimedia domain search"):
+            fetched.append((para_id, text, query, candidates, len(descs)))
+            descs.extend(f"{c['title']} {c['desc']} {c['credit']}" for c in candidates)
+
+    # semantic scoring: one batched encode per side, one similarity matrix
+    if descs:
+        para_emb = cached_encode(model, para_texts, model_name, backend=args.backend, use_cache=not args.no_cache, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        cand_emb = cached_encode(model, descs, model_name, backend=args.backend, use_cache=not args.no_cache, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        # Both sides are unit-length, so cosine similarity is a single GEMM
+        sim_matrix = (para_emb @ cand_emb.T).cpu().numpy()
+
+    n_rows = 0
+    with open(out_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_COLUMNS)
+        writer.writeheader()
+        for p, (para_id, text, query, candidates, offset) in enumerate(fetched):
+            if not candidates:
+                continue
+            sims = sim_matrix[p, offset:offset + len(candidates)]
+
+            kw_scores = keyword_overlap_scores(text, [c["desc"] for c in candidates])
+            final_scores = 0.7 * sims + 0.3 * kw_scores
+
+            for cand, sim, kw_score, final_score in zip(candidates, sims, kw_scores, final_scores):
+                if final_score >= args.min_score:
+                    writer.writerow({
+                        "chapter_id": chapter_id,
+                        "paragraph_id": para_id,
+                        "query": query,
+                        "title": cand["title"],
+                        "image_url": cand["image_url"],
+                        "page_url": cand["page_url"],
+                        "license": cand["license"],
+                        "credit": cand["credit"],
+                        "desc": cand["desc"],
+                        "semantic_score": round(float(sim), 4),
+                        "keyword_score": round(float(kw_score), 4),
+                        "final_score": round(float(final_score), 4)
+                    })
+                    n_rows += 1
+
+    # Rows were streamed in paragraph order; one pass at the end ranks them
+    out = pd.read_csv(out_csv, dtype={"chapter_id": str}).sort_values("final_score", ascending=False)
+    out.to_csv(out_csv, index=False)
+    print(f"✅ Saved {n_rows} Wikimedia domain-filtered matches → {out_csv}")
+    return out_csv
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--chapter", required=True)
+    ap.add_argument("--chapter")
+    ap.add_argument("--all-chapters", action="store_true", help="Process every chapter in the dataset")
+    ap.add_argument("--jobs", type=int, default=1, help="Chapters processed in parallel (joblib worker processes)")
     ap.add_argument("--model", choices=["all-MiniLM-L6-v2","biomed"], default="biomed")
     ap.add_argument("--topk", type=int, default=5)
     ap.add_argument("--min-score", type=float, default=0.35)
     ap.add_argument("--limit-per-para", type=int, default=30)
+    ap.add_argument("--backend", choices=["torch", "onnx", "onnx-int8"], default="torch",
+                    help="Encoder backend; onnx/onnx-int8 run on CPU via ONNX Runtime, needs sentence-transformers[onnx]")
+    ap.add_argument("--workers", type=int, default=8, help="Concurrent Wikimedia API requests")
+    ap.add_argument("--no-cache", action="store_true", help="Ignore the on-disk embedding and Wikimedia response caches")
     args = ap.parse_args()
+    if not args.chapter and not args.all_chapters:
+        ap.error("one of --chapter or --all-chapters is required")
 
-    df = pd.read_csv("data/chapters_dataset.csv")
-    df = df[df["chapter_id"].astype(str) == str(args.chapter)]
-    if df.empty:
-        print(f"⚠️ No rows for chapter {args.chapter}")
-        return
-
-    ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_csv = f"data/wikimedia_domain_matches_{args.chapter}_{ts}.csv"
-
+    chapters = list_chapter_ids() if args.all_chapters else [args.chapter]
+    args.jobs = max(1, min(args.jobs, len(chapters)))
     model_name = "all-MiniLM-L6-v2" if args.model == "all-MiniLM-L6-v2" else "gsarti/biobert-nli"
     print(f"🔤 Using model: {model_name}")
-    model = SentenceTransformer(model_name)
-
-    all_rows = []
-    for _, row in tqdm(df.iterrows(), total=len(df), desc="Wikimedia domain search"):
-        para_id, text = int(row["paragraph_id"]), str(row["text"])
-        query = build_domain_query(text)
-        candidates = wikimedia_search_files(query, limit=args.limit_per_para)
-        if not candidates:
-            continue
-
-        # semantic scoring
-        para_emb = model.encode(text, convert_to_tensor=True)
-        descs = [f"{c['title']} {c['desc']} {c['credit']}" for c in candidates]
-        cand_emb = model.encode(descs, convert_to_tensor=True)
-        sims = util.cos_sim(para_emb, cand_emb).cpu().numpy().flatten()
-
-        for cand, sim in zip(candidates, sims):
-            kw_score = keyword_overlap_score(text, cand["desc"])
-            final_score = 0.7 * float(sim) + 0.3 * kw_score
-            if final_score >= args.min_score:
-                all_rows.append({
-                    "chapter_id": args.chapter,
-                    "paragraph_id": para_id,
-                    "query": query,
-                    "title": cand["title"],
-                    "image_url": cand["image_url"],
-                    "page_url": cand["page_url"],
-                    "license": cand["license"],
-                    "credit": cand["credit"],
-                    "desc": cand["desc"],
-                    "semantic_score": round(float(sim), 4),
-                    "keyword_score": round(kw_score, 4),
-                    "final_score": round(final_score, 4)
-                })
-
-    out = pd.DataFrame(all_rows).sort_values("final_score", ascending=False)
-    out.to_csv(out_csv, index=False)
-    print(f"✅ Saved {len(out)} Wikimedia domain-filtered matches → {out_csv}")
+    Parallel(n_jobs=args.jobs)(
+        delayed(process_chapter)(chapter_id, model_name, args) for chapter_id in chapters
+    )
 
 if __name__ == "__main__":
     main()
@@ -1,20 +1,38 @@
-import os, re, time, argparse, datetime as dt
-import requests
-import pandas as pd
+import os, re, sys, csv, html, time, argparse, datetime as dt
+import numpy as np
 from bs4 import BeautifulSoup
-from sentence_transformers import SentenceTransformer, util
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from dataset import load_chapters, list_chapter_ids
+from embedding_cache import cached_encode
+from model_loader import get_model
+import wikimedia_http
 
 API = "https://commons.wikimedia.org/w/api.php"
 
+OUTPUT_COLUMNS = [
+    "source", "chapter_id", "paragraph_id", "rank", "query", "image_title",
+    "detail_url", "image_url", "image_caption", "image_credit", "license", "similarity_score"
+]
+
 MEDICAL_KEYWORDS = {
     "tumor", "carcinoma", "cancer", "neoplasm", "lesion", "biopsy", "metastasis",
     "melanoma", "sarcoma", "adenocarcinoma", "pathology", "histology",
     "epithelium", "cytology", "microscopy", "oncology", "radiology"
 }
 
+_TAG_RE = re.compile(r"<[^>]+>")
+
 def html_to_text(s):
-    return BeautifulSoup(str(s or ""), "html.parser").get_text(" ", strip=True)
+    s = str(s or "")
+    # Captions/credits are short inline HTML: strip tags with a regex and only
+    # build a DOM for structured markup (tables, lists)
+    if "<table" in s or "<ul" in s:
+        return BeautifulSoup(s, "html.parser").get_text(" ", strip=True)
+    return " ".join(html.unescape(_TAG_RE.sub(" ", s)).split())
 
 def wikimedia_search_files(query, limit=20):
     params = {
@@ -30,11 +48,14 @@ def wikimedia_search_files(query, limit=20):
         "iiurlwidth": 640,
     }
     headers = {"User-Agent": "CancerTextbookAI/1.0 (contact: kalyankumar194@gmail.com)"}
-    r = requests.get(API, params=params, headers=headers, timeout=10)
-    if r.status_code != 200 or "query" not in r.json():
+    r = wikimedia_http.get(API, params=params, headers=headers, timeout=10)
+    if r.status_code != 200:
+        return []
+    data = r.json()
+    if "query" not in data:
         return []
     results = []
-    for _, p in r.json()["query"]["pages"].items():
+    for _, p in data["query"]["pages"].items():
         info = p.get("imageinfo", [{}])[0]
         meta = info.get("extmetadata", {})
         results.append({
@@ -47,13 +68,15 @@ def wikimedia_search_files(query, limit=20):
         })
     return results
 
+_WORD_RE = re.compile(r"[A-Za-z]+")
+_STOP = frozenset({"the","and","of","to","a","in","is","on","for","with","by","as","that",
+                   "this","from","an","or","at","be","are","it","we","was","were","but",
+                   "about","into","over","without","iii","ii","iv","i","figure","chapter",
+                   "introduction","section","subsection","system","systems"})
+
 def build_query(text, max_terms=6):
-    words = re.findall(r"[A-Za-z]+", text)
-    stop = {"the","and","of","to","a","in","is","on","for","with","by","as","that",
-            "this","from","an","or","at","be","are","it","we","was","were","but",
-            "about","into","over","without","iii","ii","iv","i","figure","chapter",
-            "introduction","section","subsection","system","systems"}
-    kws = [w for w in words if w.lower() not in stop and len(w) > 2]
+    words = _WORD_RE.findall(text)
+    kws = [w for w in words if w.lower() not in _STOP and len(w) > 2]
     uniq = []
     seen = set()
     for w in kws:
@@ -63,69 +86,121 @@ def build_query(text, max_terms=6):
             uniq.append(w)
     return " ".join(uniq[:max_terms]) if uniq else "cancer"
 
-def compute_hybrid_score(model, paragraph_text, cand):
-    base_text = " ".join([cand.get("title",""), cand.get("description",""), cand.get("credit","")])
-    sem_score = util.cos_sim(
-        model.encode(paragraph_text, convert_to_tensor=True),
-        model.encode(base_text, convert_to_tensor=True)
-    ).item()
-    kw_bonus = sum(1 for kw in MEDICAL_KEYWORDS if kw.lower() in base_text.lower()) * 0.05
-    return min(1.0, sem_score + kw_bonus)
+def candidate_text(cand):
+    return " ".join([cand.get("title",""), cand.get("description",""), cand.get("credit","")])
+
+# One pass over the text finds every keyword occurrence; the lookahead also
+# reports keywords nested inside others (carcinoma in adenocarcinoma)
+_KEYWORD_RE = re.compile(
+    "(?=(" + "|".join(sorted(map(re.escape, MEDICAL_KEYWORDS), key=len, reverse=True)) + "))"
+)
+
+def keyword_bonus(base_text):
+    found = {m.group(1) for m in _KEYWORD_RE.finditer(base_text.lower())}
+    return len(found) * 0.05
+
+def process_chapter(chapter_id, model_name, args):
+    """Search, score and write the matches CSV for one chapter; returns its path."""
+    wikimedia_http.CACHE_ENABLED = not args.no_cache
+    # Chapters processed in parallel share Wikimedia's request budget
+    wikimedia_http.LIMITER.interval = args.jobs / wikimedia_http.REQUESTS_PER_SECOND
+
+    dfc = load_chapters(chapter_id)
+    if dfc.empty:
+        print(f"⚠️ No rows found for chapter {chapter_id}")
+        return
+
+    ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_csv = f"data/wikimedia_hybrid_matches_{chapter_id}_{ts}.csv"
+
+    # Paragraphs and captions are short; biobert keeps headroom for long descriptions
+    model = get_model(model_name, args.backend, max_seq_length=256 if "biobert" in model_name else 128)
+
+    # Fetch candidates for every paragraph first; paragraph p's candidates
+    # occupy cand_texts[offset:offset + len(cands)]
+    para_texts = dfc["text"].astype(str).tolist()
+
+    def fetch_for_row(row):
+        para_id, text = int(row[0]), str(row[1])
+        query = build_query(text)
+        return para_id, query, wikimedia_search_files(query, limit=args.limit_per_para)
+
+    fetched = []
+    cand_texts = []
+    kw_bonus = []
+    with ThreadPoolExecutor(max_workers=args.workers) as ex:
+        results = ex.map(fetch_for_row, dfc[["paragraph_id", "text"]].itertuples(index=False, name=None))
+        for para_id, query, cands in tqdm(results, total=len(dfc), desc="Wikimedia hybrid search"):
+            fetched.append((para_id, query, cands, len(cand_texts)))
+            texts = [candidate_text(c) for c in cands]
+            cand_texts.extend(texts)
+            kw_bonus.extend(keyword_bonus(t) for t in texts)
+
+    # One batched encode per side and one similarity matrix for the chapter
+    if cand_texts:
+        para_emb = cached_encode(model, para_texts, model_name, backend=args.backend, use_cache=not args.no_cache, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        cand_emb = cached_encode(model, cand_texts, model_name, backend=args.backend, use_cache=not args.no_cache, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        # Both sides are unit-length, so cosine similarity is a single GEMM
+        sim_matrix = (para_emb @ cand_emb.T).cpu().numpy()
+    kw_bonus = np.asarray(kw_bonus, dtype=np.float32)
+
+    n_rows = 0
+    with open(out_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_COLUMNS)
+        writer.writeheader()
+        for p, (para_id, query, cands, offset) in enumerate(fetched):
+            if not cands:
+                continue
+            # hybrid score = cosine similarity + medical keyword bonus, capped at 1
+            window = slice(offset, offset + len(cands))
+            hybrid = np.minimum(1.0, sim_matrix[p, window] + kw_bonus[window])
+
+            scored = [(float(s), c) for s, c in zip(hybrid, cands) if s >= args.min_score]
+            scored.sort(reverse=True, key=lambda x: x[0])
+            for rank, (score, c) in enumerate(scored[:args.topk], 1):
+                writer.writerow({
+                    "source": "wikimedia",
+                    "chapter_id": chapter_id,
+                    "paragraph_id": para_id,
+                    "rank": rank,
+                    "query": query.replace(" ", "+"),
+                    "image_title": c.get("title",""),
+                    "detail_url": c.get("page_url",""),
+                    "image_url": c.get("image_url",""),
+                    "image_caption": c.get("description",""),
+                    "image_credit": c.get("credit",""),
+                    "license": c.get("license",""),
+                    "similarity_score": round(score,4),
+                })
+                n_rows += 1
+
+    print(f"✅ Saved {n_rows} Wikimedia hybrid matches → {out_csv}")
+    return out_csv
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--chapter", required=True)
+    ap.add_argument("--chapter")
+    ap.add_argument("--all-chapters", action="store_true", help="Process every chapter in the dataset")
+    ap.add_argument("--jobs", type=int, default=1, help="Chapters processed in parallel (joblib worker processes)")
     ap.add_argument("--model", choices=["all-MiniLM-L6-v2","biomed"], default="all-MiniLM-L6-v2")
     ap.add_argument("--topk", type=int, default=5)
     ap.add_argument("--min-score", type=float, default=0.4)
     ap.add_argument("--limit-per-para", type=int, default=40)
+    ap.add_argument("--backend", choices=["torch", "onnx", "onnx-int8"], default="torch",
+                    help="Encoder backend; onnx/onnx-int8 run on CPU via ONNX Runtime, needs sentence-transformers[onnx]")
+    ap.add_argument("--workers", type=int, default=8, help="Concurrent Wikimedia API requests")
+    ap.add_argument("--no-cache", action="store_true", help="Ignore the on-disk embedding and Wikimedia response caches")
     args = ap.parse_args()
+    if not args.chapter and not args.all_chapters:
+        ap.error("one of --chapter or --all-chapters is required")
 
-    df = pd.read_csv("data/chapters_dataset.csv")
-    dfc = df[df["chapter_id"].astype(str) == str(args.chapter)]
-    if dfc.empty:
-        print(f"⚠️ No rows found for chapter {args.chapter}")
-        return
-
-    ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_csv = f"data/wikimedia_hybrid_matches_{args.chapter}_{ts}.csv"
-
+    chapters = list_chapter_ids() if args.all_chapters else [args.chapter]
+    args.jobs = max(1, min(args.jobs, len(chapters)))
     model_name = "all-MiniLM-L6-v2" if args.model == "all-MiniLM-L6-v2" else "gsarti/biobert-nli"
     print(f"🔤 Using model: {model_name}")
-    model = SentenceTransformer(model_name)
-
-    rows = []
-    for _, r in tqdm(dfc.iterrows(), total=len(dfc), desc="Wikimedia hybrid search"):
-        para_id = int(r["paragraph_id"])
-        text = str(r["text"])
-        query = build_query(text)
-        cands = wikimedia_search_files(query, limit=args.limit_per_para)
-
-        scored = []
-        for c in cands:
-            s = compute_hybrid_score(model, text, c)
-            if s >= args.min_score:
-                scored.append((s, c))
-        scored.sort(reverse=True, key=lambda x: x[0])
-        for rank, (score, c) in enumerate(scored[:args.topk], 1):
-            rows.append({
-                "source": "wikimedia",
-                "chapter_id": args.chapter,
-                "paragraph_id": para_id,
-                "rank": rank,
-                "query": query.replace(" ", "+"),
-                "image_title": c.get("title",""),
-                "detail_url": c.get("page_url",""),
-                "image_url": c.get("image_url",""),
-                "image_caption": c.get("description",""),
-                "image_credit": c.get("credit",""),
-                "license": c.get("license",""),
-                "similarity_score": round(score,4),
-            })
-
-    out = pd.DataFrame(rows)
-    out.to_csv(out_csv, index=False)
-    print(f"✅ Saved {len(out)} Wikimedia hybrid matches → {out_csv}")
+    Parallel(n_jobs=args.jobs)(
+        delayed(process_chapter)(chapter_id, model_name, args) for chapter_id in chapters
+    )
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,33 @@
-import os, re, time, argparse, datetime as dt
-import requests
-import pandas as pd
+import os, re, sys, csv, html, time, argparse, datetime as dt
 from bs4 import BeautifulSoup
-from sentence_transformers import SentenceTransformer, util
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from dataset import load_chapters, list_chapter_ids
+from embedding_cache import cached_encode
+from model_loader import get_model
+import wikimedia_http
 
 API = "https://commons.wikimedia.org/w/api.php"
 
+OUTPUT_COLUMNS = [
+    "source", "chapter_id", "paragraph_id", "rank", "query", "image_title",
+    "image_url", "image_caption", "image_credit", "license", "similarity_score"
+]
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
 def html_to_text(s: str) -> str:
     if not s:
         return ""
-    return BeautifulSoup(str(s), "html.parser").get_text(" ", strip=True)
+    s = str(s)
+    # Captions/credits are short inline HTML: strip tags with a regex and only
+    # build a DOM for structured markup (tables, lists)
+    if "<table" in s or "<ul" in s:
+        return BeautifulSoup(s, "html.parser").get_text(" ", strip=True)
+    return " ".join(html.unescape(_TAG_RE.sub(" ", s)).split())
 
 def extval(meta: dict, key: str) -> str:
     try:
@@ -61,7 +78,7 @@ def wikimedia_search_files(query, limit=10, categories=None):
     headers = {"User-Agent": "CancerTextbookAI/2.0 (contact: kalyankumar194@gmail.com)"}
 
     try:
-        r = requests.get(API, params=params, headers=headers, timeout=15)
+        r = wikimedia_http.get(API, params=params, headers=headers, timeout=15)
         r.raise_for_status()
         data = r.json()
     except Exception as e:
@@ -89,10 +106,12 @@ def wikimedia_search_files(query, limit=10, categories=None):
         })
     return results
 
+_WORD_RE = re.compile(r"[A-Za-z]+")
+_STOP = frozenset({"the","and","of","to","a","in","is","on","for","with","by","as","that","this","from","an","or","at","be","are","it","we"})
+
 def build_query(text: str, max_terms: int = 6):
-    words = re.findall(r"[A-Za-z]+", text)
-    stop = {"the","and","of","to","a","in","is","on","for","with","by","as","that","this","from","an","or","at","be","are","it","we"}
-    kws = [w for w in words if w.lower() not in stop and len(w) > 2]
+    words = _WORD_RE.findall(text)
+    kws = [w for w in words if w.lower() not in _STOP and len(w) > 2]
     uniq = []
     seen = set()
     for w in kws:
@@ -102,70 +121,108 @@ def build_query(text: str, max_terms: int = 6):
             uniq.append(w)
     return " ".join(uniq[:max_terms]) if uniq else "cancer"
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--chapter", required=True, help="Chapter ID, e.g. 31_")
-    ap.add_argument("--every", type=int, default=1, help="Use every Nth paragraph")
-    ap.add_argument("--limit-per-para", type=int, default=25, help="Max Wikimedia candidates per paragraph")
-    ap.add_argument("--topk", type=int, default=5, help="Top-k to keep per paragraph")
-    ap.add_argument("--min-score", type=float, default=0.55, help="Minimum similarity score")
-    ap.add_argument("--model", choices=["all-MiniLM-L6-v2", "biomed"], default="all-MiniLM-L6-v2")
-    args = ap.parse_args()
+def process_chapter(chapter_id, model_name, args):
+    """Search, score and write the matches CSV for one chapter; returns its path."""
+    wikimedia_http.CACHE_ENABLED = not args.no_cache
+    # Chapters processed in parallel share Wikimedia's request budget
+    wikimedia_http.LIMITER.interval = args.jobs / wikimedia_http.REQUESTS_PER_SECOND
 
     os.makedirs("data", exist_ok=True)
-    df = pd.read_csv("data/chapters_dataset.csv")
-    dfc = df[df["chapter_id"].astype(str) == str(args.chapter)].copy()
+    dfc = load_chapters(chapter_id)
     if dfc.empty:
-        print(f"⚠️ No rows for chapter {args.chapter}")
+        print(f"⚠️ No rows for chapter {chapter_id}")
         return
 
     ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_csv = f"data/wikimedia_semantic_matches_{args.chapter}_{ts}.csv"
+    out_csv = f"data/wikimedia_semantic_matches_{chapter_id}_{ts}.csv"
 
-    model_name = "all-MiniLM-L6-v2" if args.model == "all-MiniLM-L6-v2" else "gsarti/biobert-nli"
-    print(f"🔤 Embedding model: {model_name}")
-    model = SentenceTransformer(model_name)
+    # Paragraphs and captions are short; biobert keeps headroom for long descriptions
+    model = get_model(model_name, args.backend, max_seq_length=256 if "biobert" in model_name else 128)
 
-    rows = []
+    # Fetch candidates for every paragraph first; paragraph p's candidates
+    # occupy cand_texts[offset:offset + len(candidates)]
     work_df = dfc.iloc[::args.every]
-    for _, r in tqdm(work_df.iterrows(), total=len(work_df), desc="Wikimedia search"):
-        para_id = int(r["paragraph_id"])
-        text = str(r["text"])
+    para_texts = work_df["text"].astype(str).tolist()
+
+    def fetch_for_row(row):
+        para_id, text = int(row[0]), str(row[1])
         base_query = build_query(text)
         expanded_query = expand_query_terms(base_query)
+        return para_id, expanded_query, wikimedia_search_files(expanded_query, limit=args.limit_per_para)
+
+    fetched = []
+    cand_texts = []
+    with ThreadPoolExecutor(max_workers=args.workers) as ex:
+        results = ex.map(fetch_for_row, work_df[["paragraph_id", "text"]].itertuples(index=False, name=None))
+        for para_id, expanded_query, candidates in tqdm(results, total=len(work_df), desc="Wikimedia search"):
+            fetched.append((para_id, expanded_query, candidates, len(cand_texts)))
+            cand_texts.extend(f"{c['title']} {c['description']} {c['credit']}" for c in candidates)
+
+    # One batched encode per side and one similarity matrix for the chapter
+    if cand_texts:
+        para_emb = cached_encode(model, para_texts, model_name, backend=args.backend, use_cache=not args.no_cache, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        cand_emb = cached_encode(model, cand_texts, model_name, backend=args.backend, use_cache=not args.no_cache, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        # Both sides are unit-length, so cosine similarity is a single GEMM
+        sim_matrix = (para_emb @ cand_emb.T).cpu().numpy()
+
+    n_rows = 0
+    with open(out_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_COLUMNS)
+        writer.writeheader()
+        for p, (para_id, expanded_query, candidates, offset) in enumerate(fetched):
+            if not candidates:
+                continue
+            sims = sim_matrix[p, offset:offset + len(candidates)]
+
+            for c, s in zip(candidates, sims):
+                c["similarity_score"] = float(s)
+            ranked = sorted(candidates, key=lambda x: x["similarity_score"], reverse=True)
+            top = [x for x in ranked if x["similarity_score"] >= args.min_score][:args.topk]
+
+            for rank, c in enumerate(top, 1):
+                writer.writerow({
+                    "source": "wikimedia",
+                    "chapter_id": chapter_id,
+                    "paragraph_id": para_id,
+                    "rank": rank,
+                    "query": expanded_query.replace(" ", "+"),
+                    "image_title": c.get("title",""),
+                    "image_url": c.get("image_url",""),
+                    "image_caption": c.get("description",""),
+                    "image_credit": c.get("credit",""),
+                    "license": c.get("license",""),
+                    "similarity_score": round(float(c["similarity_score"]), 4),
+                })
+                n_rows += 1
+
+    print(f"✅ Saved {n_rows} Wikimedia rows → {out_csv}")
+    return out_csv
 
-        candidates = wikimedia_search_files(expanded_query, limit=args.limit_per_para)
-        if not candidates:
-            continue
-
-        para_emb = model.encode(text, convert_to_tensor=True)
-        cand_texts = [f"{c['title']} {c['description']} {c['credit']}" for c in candidates]
-        cand_emb = model.encode(cand_texts, convert_to_tensor=True)
-        sims = util.cos_sim(para_emb, cand_emb).cpu().numpy().flatten()
-
-        for c, s in zip(candidates, sims):
-            c["similarity_score"] = float(s)
-        ranked = sorted(candidates, key=lambda x: x["similarity_score"], reverse=True)
-        top = [x for x in ranked if x["similarity_score"] >= args.min_score][:args.topk]
-
-        for rank, c in enumerate(top, 1):
-            rows.append({
-                "source": "wikimedia",
-                "chapter_id": args.chapter,
-                "paragraph_id": para_id,
-                "rank": rank,
-                "query": expanded_query.replace(" ", "+"),
-                "image_title": c.get("title",""),
-                "image_url": c.get("image_url",""),
-                "image_caption": c.get("description",""),
-                "image_credit": c.get("credit",""),
-                "license": c.get("license",""),
-                "similarity_score": round(float(c["similarity_score"]), 4),
-            })
-
-    out = pd.DataFrame(rows)
-    out.to_csv(out_csv, index=False)
-    print(f"✅ Saved {len(out)} Wikimedia rows → {out_csv}")
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chapter", help="Chapter ID, e.g. 31_")
+    ap.add_argument("--all-chapters", action="store_true", help="Process every chapter in the dataset")
+    ap.add_argument("--jobs", type=int, default=1, help="Chapters processed in parallel (joblib worker processes)")
+    ap.add_argument("--every", type=int, default=1, help="Use every Nth paragraph")
+    ap.add_argument("--limit-per-para", type=int, default=25, help="Max Wikimedia candidates per paragraph")
+    ap.add_argument("--topk", type=int, default=5, help="Top-k to keep per paragraph")
+    ap.add_argument("--min-score", type=float, default=0.55, help="Minimum similarity score")
+    ap.add_argument("--model", choices=["all-MiniLM-L6-v2", "biomed"], default="all-MiniLM-L6-v2")
+    ap.add_argument("--backend", choices=["torch", "onnx", "onnx-int8"], default="torch",
+                    help="Encoder backend; onnx/onnx-int8 run on CPU via ONNX Runtime, needs sentence-transformers[onnx]")
+    ap.add_argument("--workers", type=int, default=8, help="Concurrent Wikimedia API requests")
+    ap.add_argument("--no-cache", action="store_true", help="Ignore the on-disk embedding and Wikimedia response caches")
+    args = ap.parse_args()
+    if not args.chapter and not args.all_chapters:
+        ap.error("one of --chapter or --all-chapters is required")
+
+    chapters = list_chapter_ids() if args.all_chapters else [args.chapter]
+    args.jobs = max(1, min(args.jobs, len(chapters)))
+    model_name = "all-MiniLM-L6-v2" if args.model == "all-MiniLM-L6-v2" else "gsarti/biobert-nli"
+    print(f"🔤 Embedding model: {model_name}")
+    Parallel(n_jobs=args.jobs)(
+        delayed(process_chapter)(chapter_id, model_name, args) for chapter_id in chapters
+    )
 
 if __name__ == "__main__":
     main()